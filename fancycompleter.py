@@ -5,19 +5,25 @@ from __future__ import with_statement
 from __future__ import print_function
 
 import rlcompleter
+import re  # already imported by rlcompleter
 import sys
 import types
 import os.path
-from itertools import count
+import weakref
+from bisect import bisect_left
+from collections import namedtuple
+from itertools import chain, compress, count, repeat
+from operator import contains
 
 PY3K = sys.version_info[0] >= 3
 
 # python3 compatibility
 # ---------------------
 try:
-    from itertools import izip
+    from itertools import izip, imap
 except ImportError:
     izip = zip
+    imap = map
 
 try:
     from types import ClassType
@@ -29,6 +35,33 @@ try:
 except NameError:
     unicode = str
 
+try:
+    import builtins
+except ImportError:
+    import __builtin__ as builtins
+
+try:
+    from _thread import allocate_lock
+except ImportError:
+    from thread import allocate_lock
+
+_viewkeys = getattr(dict, 'viewkeys', dict.keys)
+
+if hasattr(int, 'from_bytes'):
+    def _bytes_to_int(data):
+        return int.from_bytes(data, 'little')
+
+    def _int_to_bytes(n, length):
+        return n.to_bytes(length, 'little')
+else:
+    from binascii import hexlify, unhexlify
+
+    def _bytes_to_int(data):
+        return int(hexlify(bytes(data[::-1])) or '0', 16)
+
+    def _int_to_bytes(n, length):
+        return unhexlify('%0*x' % (2 * length, n))[::-1]
+
 # ----------------------
 
 
@@ -46,13 +79,17 @@ class LazyVersion(object):
 
     def _load_version(self):
         try:
-            from pkg_resources import get_distribution, DistributionNotFound
+            from importlib.metadata import version, PackageNotFoundError
         except ImportError:
-            return 'N/A'
+            try:
+                # backport for Python < 3.8
+                from importlib_metadata import version, PackageNotFoundError
+            except ImportError:
+                return 'N/A'
         #
         try:
-            return get_distribution(self.pkg).version
-        except DistributionNotFound:
+            return version(self.pkg)
+        except PackageNotFoundError:
             # package is not installed
             return 'N/A'
 
@@ -70,6 +107,35 @@ __version__ = LazyVersion(__name__)
 
 # ----------------------
 
+try:
+    from time import perf_counter as _timer
+except ImportError:  # Python 2
+    from time import time as _timer
+
+
+class _Deadline(object):
+    """
+    The time budget of a single completion.
+    """
+
+    def __init__(self, budget_ms=None):
+        if budget_ms is None:
+            self.expires = None
+        else:
+            self.expires = _timer() + budget_ms / 1000.0
+        self._expired = False
+
+    def expired(self):
+        if not self._expired and self.expires is not None:
+            self._expired = _timer() >= self.expires
+        return self._expired
+
+
+# placeholder for the values which have not been looked up
+_unresolved = object()
+
+# ----------------------
+
 
 class Color:
     black = '30'
@@ -98,12 +164,180 @@ class Color:
         return '\x1b[%sm%s\x1b[00m' % (color, string)
 
 
+_color_starts = {}
+
+
+def color_start(color):
+    """Return the escape sequence which starts 'color', like Color.set."""
+    try:
+        return _color_starts[color]
+    except KeyError:
+        start = _color_starts[color] = '\x1b[%sm' % getattr(Color, color, color)
+        return start
+
+
+_index_prefixes = []
+
+
+def index_prefix(i):
+    """
+    Return the fake escape sequence prepended to the i-th match, so that
+    readline sorts the matches in our order.
+    """
+    try:
+        return _index_prefixes[i]
+    except IndexError:
+        _index_prefixes.extend(['\x1b[%03d;00m' % j
+                                for j in range(len(_index_prefixes), i + 1)])
+        return _index_prefixes[i]
+
+
+class _Match(object):
+    """
+    A colored match, rendered into the string which readline gets only when
+    it asks for it: 'index' is the position used for the ordering prefix.
+    """
+
+    __slots__ = ('name', 'color', 'index')
+
+    def __init__(self, name, color, index):
+        self.name = name
+        self.color = color
+        self.index = index
+
+    def render(self):
+        if self.color is None:
+            return index_prefix(self.index) + self.name
+        return (index_prefix(self.index) + color_start(self.color) +
+                self.name + '\x1b[00m')
+
+
+def render_matches(matches):
+    """Return 'matches' with the _Match records rendered into strings."""
+    return [match.render() if type(match) is _Match else match
+            for match in matches]
+
+
+_display_widths = {}
+
+
+def display_width(name):
+    """Return the number of terminal columns taken by 'name' (cached)."""
+    try:
+        return _display_widths[name]
+    except KeyError:
+        pass
+    try:
+        name.encode('ascii')
+        width = len(name)
+    except UnicodeError:
+        import unicodedata
+        width = 0
+        for c in name:
+            if unicodedata.combining(c):
+                continue
+            width += 2 if unicodedata.east_asian_width(c) in 'WF' else 1
+    if len(_display_widths) > 100000:
+        _display_widths.clear()
+    _display_widths[name] = width
+    return width
+
+
+def layout_matches(matches, width):
+    """
+    Return the text which lists 'matches' (_Match records or plain strings)
+    in columns, sorted down the columns like readline does, for a terminal
+    'width' columns wide.  The color escape sequences are emitted only when
+    the color changes from a name to the next one, and there are no
+    ordering prefixes.
+    """
+    cells = []
+    for match in matches:
+        if type(match) is _Match:
+            cells.append((match.name, match.color))
+        elif match.strip():
+            cells.append((match, None))
+    if not cells:
+        return ''
+    widths = [display_width(name) for name, _ in cells]
+    col_width = max(widths) + 2
+    ncols = max(1, (width - 1) // col_width)
+    nrows = (len(cells) + ncols - 1) // ncols
+    out = []
+    current = None
+    for row in range(nrows):
+        for i in range(row, len(cells), nrows):
+            name, color = cells[i]
+            if color != current:
+                out.append('\x1b[00m' if color is None else color_start(color))
+                current = color
+            out.append(name)
+            if i + nrows < len(cells):
+                out.append(' ' * (col_width - widths[i]))
+        out.append('\n')
+    if current is not None:
+        out.insert(-1, '\x1b[00m')
+    return ''.join(out)
+
+
+_best_readline_cache = {}
+
+
 class DefaultConfig:
 
     consider_getitems = True
     prefer_pyrepl = True
     use_colors = 'auto'
+    # look up attribute values without running properties, __getattr__ and
+    # other user-defined descriptors (see static_lookup)
+    static_attr_lookup = False
     readline = None  # set by setup()
+    # time budget for a single completion, in milliseconds: when it runs out,
+    # the names found so far are returned, without coloring the ones whose
+    # value has not been looked up yet.  None means no limit.
+    completion_budget_ms = None
+    # compute the completions in a worker thread, and give up waiting for
+    # them after this many milliseconds: see CompletionWorker.  None means
+    # that they are computed in the calling thread.
+    completion_timeout_ms = None
+    # warm up the attribute names of the objects of the namespace in a
+    # background thread, using at most prefetch_cpu_share of the CPU
+    prefetch = False
+    prefetch_cpu_share = 0.1
+    # time the phases of the completions and count the cache hits, see
+    # Completer.stats().  The stats are always collected, and printed at
+    # exit, if the FANCYCOMPLETER_STATS environment variable is set.
+    collect_stats = False
+    # also complete the names which contain the typed characters in order,
+    # e.g. 'gvc' -> 'get_value_counts', best matches first, once at least
+    # two characters are typed; only the best few hundred matches of a
+    # namespace are listed (see FuzzyIndex)
+    fuzzy_matching = False
+    # complete the keys of dicts and mappings in subscripts like d['<TAB>,
+    # looking at most at the first max_keys keys
+    complete_keys = True
+    max_keys = 10000
+    # with interact(persist_history=...), load only the last history_length
+    # entries and append the new ones to the file at exit, instead of
+    # rewriting it: parallel sessions don't overwrite each other
+    history_append = False
+    history_length = 10000
+    # list first the names completed most often on the same type or module;
+    # the counts are saved in the cache directory
+    rank_by_usage = False
+    # complete the module names in import statements; the modules found on
+    # sys.path are cached in the cache directory
+    complete_imports = True
+    # remember the attribute names and colors of the modules across
+    # sessions, in the cache directory, for at most module_cache_size modules
+    module_cache = False
+    module_cache_size = 50
+    # with GNU readline, list the matches with our own column layout, which
+    # sends far fewer escape sequences to the terminal
+    self_layout = False
+    # list at most this many matches (and look up only their values),
+    # followed by a "... N more" entry.  None means no limit.
+    max_matches = None
     using_pyrepl = False  # overwritten by find_pyrepl
 
     color_by_type = {
@@ -161,70 +395,1844 @@ class DefaultConfig:
         else:
             return readline, False
 
-    def find_best_readline(self):
-        if self.prefer_pyrepl:
-            result = self.find_pyrepl()
-            if result:
-                return result
-        if sys.platform == 'win32':
-            result = self.find_pyreadline()
-            if result:
-                return result
-        import readline
-        return readline, False  # by default readline does not support colors
+    def find_best_readline(self):
+        # probing the backends imports them: do it only once per process
+        key = (type(self), self.prefer_pyrepl)
+        try:
+            result, self.using_pyrepl = _best_readline_cache[key]
+        except KeyError:
+            result = self._find_best_readline()
+            _best_readline_cache[key] = result, self.using_pyrepl
+        return result
+
+    def _find_best_readline(self):
+        if self.prefer_pyrepl:
+            result = self.find_pyrepl()
+            if result:
+                return result
+        if sys.platform == 'win32':
+            result = self.find_pyreadline()
+            if result:
+                return result
+        import readline
+        return readline, False  # by default readline does not support colors
+
+    def setup(self):
+        self.readline, supports_color = self.find_best_readline()
+        if self.use_colors == 'auto':
+            self.use_colors = supports_color
+
+
+def get_cache_dir():
+    """
+    Return the directory where fancycompleter keeps its caches, creating it
+    if needed, or None if it cannot be created.
+    """
+    base = os.environ.get('XDG_CACHE_HOME')
+    if not base:
+        base = os.path.join(os.path.expanduser('~'), '.cache')
+    path = os.path.join(base, 'fancycompleter')
+    if not os.path.isdir(path):
+        try:
+            os.makedirs(path)
+        except OSError:
+            return None
+    return path
+
+
+def _stat_key(st):
+    return getattr(st, 'st_mtime_ns', st.st_mtime), st.st_size
+
+
+def _cache_tag():
+    implementation = getattr(sys, 'implementation', None)
+    if implementation is not None and implementation.cache_tag:
+        return implementation.cache_tag
+    return 'py%d%d' % sys.version_info[:2]
+
+
+def write_cache_file(path, data):
+    """Atomically write 'data' to 'path'; errors are ignored."""
+    tmp = '%s.%d.tmp' % (path, os.getpid())
+    try:
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        if sys.platform == 'win32' and os.path.exists(path):
+            os.remove(path)
+        os.rename(tmp, path)
+    except (IOError, OSError):
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+
+
+def read_json_cache(path):
+    """
+    Return the dict saved to 'path' by write_json_cache(), or {} if 'path'
+    is None, missing or invalid.
+    """
+    import json
+    if path is None:
+        return {}
+    try:
+        with open(path, 'rb') as f:
+            data = json.loads(f.read().decode('utf-8'))
+    except (IOError, OSError, ValueError):
+        return {}
+    if not isinstance(data, dict):
+        return {}
+    return data
+
+
+def write_json_cache(path, data):
+    """Atomically write the dict 'data' to 'path' as JSON."""
+    import json
+    write_cache_file(path, json.dumps(data, separators=(',', ':'),
+                                      sort_keys=True).encode('utf-8'))
+
+
+def cache_file_path(name):
+    """Return the path of the file 'name' in the cache directory, or None."""
+    cache_dir = get_cache_dir()
+    if cache_dir is None:
+        return None
+    return os.path.join(cache_dir, name)
+
+
+def compile_cached(filename):
+    """
+    Compile the source file 'filename', caching the code object on disk
+    like py_compile does: the cache is keyed by the path of the file, and is
+    valid as long as its mtime and size don't change.
+    """
+    import marshal
+    from hashlib import sha1
+
+    st = os.stat(filename)
+    header = ('%s %r\n' % (os.path.abspath(filename),
+                           _stat_key(st))).encode('utf-8')
+    cache_dir = get_cache_dir()
+    cache_file = None
+    if cache_dir is not None:
+        digest = sha1(os.path.abspath(filename).encode('utf-8')).hexdigest()
+        cache_file = os.path.join(cache_dir, 'rc-%s.%s.pyc' % (
+            digest[:16], _cache_tag()))
+        try:
+            with open(cache_file, 'rb') as f:
+                data = f.read()
+            if data.startswith(header):
+                return marshal.loads(data[len(header):])
+        except (IOError, OSError, ValueError, EOFError, TypeError):
+            pass
+    with open(filename) as f:
+        code = compile(f.read(), filename, 'exec')
+    if cache_file is not None:
+        write_cache_file(cache_file, header + marshal.dumps(code))
+    return code
+
+
+def my_execfile(filename, mydict):
+    code = compile_cached(filename)
+    exec(code, mydict)
+
+
+class ConfigurableClass:
+    DefaultConfig = None
+    config_filename = None
+
+    # rcfile -> ((mtime, size), Config) of the config files already loaded
+    _config_cache = {}
+
+    def get_config(self, Config):
+        if Config is not None:
+            return Config()
+        # try to load config from the ~/filename file
+        filename = '~/' + self.config_filename
+        rcfile = os.path.normpath(os.path.expanduser(filename))
+        try:
+            key = _stat_key(os.stat(rcfile))
+        except OSError:
+            return self.DefaultConfig()
+
+        cached = self._config_cache.get(rcfile)
+        if cached is not None and cached[0] == key:
+            Config = cached[1]
+        else:
+            mydict = {}
+            try:
+                my_execfile(rcfile, mydict)
+            except Exception as exc:
+                import traceback
+
+                sys.stderr.write("** error when importing %s: %r **\n" % (
+                    filename, exc))
+                traceback.print_tb(sys.exc_info()[2])
+                return self.DefaultConfig()
+
+            Config = mydict.get("Config")
+            self._config_cache[rcfile] = key, Config
+
+        if Config is None:
+            return self.DefaultConfig()
+
+        try:
+            return Config()
+        except Exception as exc:
+            err = "error when setting up Config from %s: %s" % (filename, exc)
+            tb = sys.exc_info()[2]
+            if tb and tb.tb_next:
+                tb = tb.tb_next
+                err_fname = tb.tb_frame.f_code.co_filename
+                err_lnum = tb.tb_lineno
+                err += " (%s:%d)" % (err_fname, err_lnum,)
+            sys.stderr.write("** %s **\n" % err)
+        return self.DefaultConfig()
+
+
+# descriptors which are implemented in C or just bind an object, so calling
+# their __get__ does not run any user code
+_safe_descriptors = (
+    types.FunctionType,
+    types.MethodType,
+    staticmethod,
+    classmethod,
+    type(str.replace),
+    type(int.__add__),
+    type(dict.__dict__['fromkeys']),
+    types.MemberDescriptorType,
+    types.GetSetDescriptorType,
+)
+
+
+_missing = object()
+
+
+def _static_mro(klass):
+    return type.__dict__['__mro__'].__get__(klass)
+
+
+def _static_bind(attr, instance, owner):
+    if not hasattr(type(attr), '__get__'):
+        return attr
+    if isinstance(attr, _safe_descriptors):
+        return attr.__get__(instance, owner)
+    # properties and the like: don't run them, and let the caller color the
+    # descriptor itself
+    return attr
+
+
+def static_lookup(obj, name):
+    """
+    Return the value of the attribute 'name' of 'obj', in the style of
+    inspect.getattr_static: only the __dict__ of the object and of its
+    classes are looked at, and only the descriptors known not to run user
+    code are bound.  Other descriptors (e.g. properties) are returned as
+    they are.
+
+    If the attribute cannot be found that way (e.g. because it is provided
+    by __getattr__), fall back to a real getattr.
+    """
+    try:
+        if isinstance(obj, type):
+            for klass in _static_mro(obj):
+                if name in klass.__dict__:
+                    return _static_bind(klass.__dict__[name], None, obj)
+            meta = type(obj)
+            for klass in _static_mro(meta):
+                if name in klass.__dict__:
+                    return _static_bind(klass.__dict__[name], obj, meta)
+        else:
+            tp = type(obj)
+            class_attr = _missing
+            for klass in _static_mro(tp):
+                if name in klass.__dict__:
+                    class_attr = klass.__dict__[name]
+                    break
+            is_data_descr = (hasattr(type(class_attr), '__set__') or
+                             hasattr(type(class_attr), '__delete__'))
+            if class_attr is not _missing and is_data_descr:
+                return _static_bind(class_attr, obj, tp)
+            try:
+                instance_dict = object.__getattribute__(obj, '__dict__')
+            except AttributeError:
+                instance_dict = {}
+            if isinstance(instance_dict, dict) and name in instance_dict:
+                return instance_dict[name]
+            if class_attr is not _missing:
+                return _static_bind(class_attr, obj, tp)
+    except TypeError:
+        # e.g. old-style classes and instances on Python 2
+        pass
+    return getattr(obj, name)
+
+
+def _dir_words(obj):
+    """Return the set of names to complete for the attributes of 'obj'."""
+    words = set(dir(obj))
+    words.discard('__builtins__')
+    if hasattr(obj, '__class__'):
+        words.add('__class__')
+        words.update(rlcompleter.get_class_members(obj.__class__))
+    return words
+
+
+def _class_words(klass):
+    """Return the set of names that instances of 'klass' get from it."""
+    words = set(rlcompleter.get_class_members(klass))
+    words.add('__class__')
+    words.discard('__builtins__')
+    return words
+
+
+def keys_signature(d):
+    """
+    Return a token which changes whenever a key is added to or removed from
+    the dict (or mappingproxy) 'd': its size and its last key, since new
+    keys are inserted at the end.
+    """
+    if not d:
+        return 0, None
+    try:
+        return len(d), next(reversed(d))
+    except TypeError:
+        # not reversible before Python 3.8 (3.9 for mappingproxy): compare
+        # all the keys instead
+        return frozenset(d.keys())
+
+
+def _type_signature(klass):
+    # changes whenever a name is added to or removed from the class or one
+    # of its bases
+    return tuple([keys_signature(k.__dict__) for k in klass.__mro__])
+
+
+def _prefix_slice(words, prefix):
+    """Return the slice of the sorted list 'words' starting with 'prefix'."""
+    if not prefix:
+        return slice(None)
+    lo = hi = bisect_left(words, prefix)
+    while hi < len(words) and words[hi].startswith(prefix):
+        hi += 1
+    return slice(lo, hi)
+
+
+_object_dir = getattr(object, '__dir__', None)
+_type_dir = getattr(type, '__dir__', None)
+_module_dir = getattr(types.ModuleType, '__dir__', None)
+_module_dict = types.ModuleType.__dict__['__dict__'].__get__
+_type_dict = type.__dict__['__dict__'].__get__
+
+
+def _static_dict(obj):
+    """
+    Return the __dict__ of 'obj' if it is a module or a class, else None,
+    without running any code of 'obj' or of its type.
+    """
+    tp = type(obj)
+    if issubclass(tp, types.ModuleType):
+        return _module_dict(obj)
+    if issubclass(tp, type):
+        return _type_dict(obj)
+    return None
+
+
+class AttrIndex(object):
+    """
+    Cache of the sorted attribute names of classes and modules.
+
+    Instances of classes which don't override __dir__ share the entry of
+    their class, and the names in their own __dict__ are merged in at lookup
+    time.  Entries are invalidated when the class (or one of its bases) or
+    the module gains or loses names; objects with a custom __dir__ are never
+    cached.
+
+    The index can be shared with a Prefetcher thread.
+    """
+
+    def __init__(self):
+        self._cache = weakref.WeakKeyDictionary()
+        # modules cannot be weakly referenced on Python 2, and are never
+        # freed anyway
+        self._modules = {}
+        self._lock = allocate_lock()
+        self.hits = self.misses = 0
+
+    def _cache_for(self, key):
+        if not PY3K and type(key) is types.ModuleType:
+            return self._modules
+        return self._cache
+
+    def _key(self, obj):
+        """
+        Return (key, signature, compute, instance_dict) for 'obj', or None if
+        its names cannot be cached.
+        """
+        tp = type(obj)
+        if tp is types.ModuleType:
+            if ('__dir__' in obj.__dict__ or
+                    getattr(tp, '__dir__', None) is not _module_dir):
+                return None
+            return obj, keys_signature(obj.__dict__), _dir_words, None
+        if issubclass(tp, type):
+            if getattr(tp, '__dir__', None) is not _type_dir:
+                return None
+            signature = (_type_signature(obj), _type_signature(tp))
+            return obj, signature, _dir_words, None
+        if (getattr(tp, '__dir__', None) is not _object_dir or
+                getattr(type(tp), '__dir__', None) is not _type_dir or
+                getattr(obj, '__class__', None) is not tp):
+            return None
+        instance_dict = getattr(obj, '__dict__', None)
+        if not isinstance(instance_dict, dict):
+            instance_dict = None
+        return tp, _type_signature(tp), _class_words, instance_dict
+
+    def _words(self, obj):
+        """Return (sorted_words, instance_dict) for 'obj'."""
+        try:
+            info = self._key(obj)
+        except AttributeError:  # e.g. old-style classes
+            info = None
+        if info is None:
+            return sorted(_dir_words(obj)), None
+        key, signature, compute, instance_dict = info
+        return self._cached(key, signature, compute), instance_dict
+
+    def _cached(self, key, signature, compute):
+        cache = self._cache_for(key)
+        try:
+            with self._lock:
+                entry = cache.get(key)
+        except TypeError:  # unhashable metaclass
+            return sorted(compute(key))
+        if entry is None or entry[0] != signature:
+            self.misses += 1
+            entry = (signature, sorted(compute(key)))
+            with self._lock:
+                cache[key] = entry
+        else:
+            self.hits += 1
+        return entry[1]
+
+    def warm(self, obj):
+        """
+        Make sure that the names of 'obj' are in the cache.  Return False if
+        they cannot be cached, without calling dir() on 'obj'.
+        """
+        try:
+            if self._key(obj) is None:
+                return False
+        except AttributeError:
+            return False
+        self._words(obj)
+        return True
+
+    def warm_instances(self, klass):
+        """
+        Like warm(), for the names which the instances of 'klass' get from
+        it, without looking at any instance.
+        """
+        if (getattr(klass, '__dir__', None) is not _object_dir or
+                getattr(type(klass), '__dir__', None) is not _type_dir):
+            return False
+        try:
+            self._cached(klass, _type_signature(klass), _class_words)
+        except AttributeError:  # e.g. old-style classes
+            return False
+        return True
+
+    def seed(self, module, signature, words):
+        """
+        Cache the sorted 'words' of 'module', e.g. loaded from disk, unless
+        they are already cached.  They are used only if 'signature', the
+        keys_signature() of its __dict__ when they were computed, is still
+        current.
+        """
+        if signature != keys_signature(module.__dict__):
+            return False
+        with self._lock:
+            cache = self._cache_for(module)
+            if module not in cache:
+                cache[module] = (signature, words)
+        return True
+
+    def signature(self, obj):
+        """
+        Return a token which changes when the names of 'obj' change, or None
+        if they cannot be tracked (e.g. because of a custom __dir__).
+        """
+        try:
+            info = self._key(obj)
+        except AttributeError:
+            return None
+        if info is None:
+            return None
+        key, signature, compute, instance_dict = info
+        return signature, keys_signature(instance_dict)
+
+    def matches(self, obj, prefix=''):
+        """Return the sorted attribute names of 'obj' starting with 'prefix'."""
+        words, instance_dict = self._words(obj)
+        result = words[_prefix_slice(words, prefix)]
+        if instance_dict:
+            extra = [word for word in instance_dict
+                     if isinstance(word, (str, unicode)) and
+                     word.startswith(prefix) and word != '__builtins__']
+            if extra:
+                result = sorted(set(result).union(extra))
+        return result
+
+
+class Prefetcher(object):
+    """
+    Warm up the AttrIndex of a completer in a background thread, while the
+    prompt is idle.
+
+    The objects bound to the most recently completed names come first, then
+    the modules of the namespace by decreasing size, then everything else;
+    the modules and classes they contain are warmed up as well, together
+    with the color cache for the types of their values.  Only the
+    objects whose names the AttrIndex can cache are looked at, so that no
+    custom __dir__ runs in the background; of the other objects, only their
+    class is, so that no property or __getattr__ runs either.
+
+    The thread wakes up after each completion (see notify()), sleeps as long
+    as needed to use at most 'cpu_share' of the CPU, and exits when stop()
+    is called or the completer goes away.
+    """
+
+    max_recent = 32
+
+    def __init__(self, completer, cpu_share=0.1):
+        import threading
+        self.cpu_share = cpu_share
+        self._recent = []
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._completer = weakref.ref(completer, self._completer_gone)
+        self._thread = threading.Thread(target=self._run,
+                                        name='fancycompleter-prefetch')
+        self._thread.daemon = True
+
+    def start(self):
+        self._wakeup.set()
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread.ident is not None:
+            self._thread.join(timeout)
+
+    def _completer_gone(self, ref):
+        self._stopped.set()
+        self._wakeup.set()
+
+    def notify(self, name):
+        """Record that 'name' has just been completed, and wake up."""
+        with self._lock:
+            if name in self._recent:
+                self._recent.remove(name)
+            self._recent.append(name)
+            del self._recent[:-self.max_recent]
+        self._wakeup.set()
+
+    def candidates(self, namespace):
+        """Return the objects of 'namespace' to warm up, in order."""
+        with self._lock:
+            recent = self._recent[::-1]
+        try:
+            items = list(namespace.items())
+        except RuntimeError:  # changed size during iteration
+            return []
+        result = [namespace[name] for name in recent if name in namespace]
+        modules = [obj for name, obj in items
+                   if issubclass(type(obj), types.ModuleType)]
+        modules.sort(key=lambda mod: -len(_static_dict(mod)))
+        result += modules
+        result += [obj for name, obj in items
+                   if not issubclass(type(obj), types.ModuleType)]
+        return result
+
+    def _children(self, obj):
+        # the modules and classes directly reachable from a module or class
+        try:
+            values = list(_static_dict(obj).values())
+        except (AttributeError, RuntimeError):
+            return []
+        return [value for value in values
+                if _static_dict(value) is not None]
+
+    def _throttle(self, elapsed):
+        if self.cpu_share < 1:
+            self._stopped.wait(elapsed * (1 - self.cpu_share) / self.cpu_share)
+
+    def warm_up(self):
+        """Warm up the index once; return False if stopped in the middle."""
+        completer = self._completer()
+        if completer is None:
+            return False
+        index = completer.attr_index
+        namespace = completer.get_namespace()
+        seen = set()
+        for obj in self.candidates(namespace):
+            todo = [obj]
+            if _static_dict(obj) is not None:
+                todo += self._children(obj)
+            for item in todo:
+                if self._stopped.is_set():
+                    return False
+                if id(item) in seen:
+                    continue
+                seen.add(id(item))
+                start = _timer()
+                tp = type(item)
+                if tp is types.ModuleType or issubclass(tp, type):
+                    warm = index.warm
+                else:
+                    item = tp
+                    warm = index.warm_instances
+                try:
+                    if warm(item) and completer.config.use_colors:
+                        completer.classify_values(item)
+                except Exception:
+                    pass
+                self._throttle(_timer() - start)
+        return True
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._wakeup.wait()
+            self._wakeup.clear()
+            self.warm_up()
+
+
+class NameIndex(object):
+    """
+    Sorted index of the names of a namespace dict.
+
+    Looking up the names starting with a prefix costs a bisect plus the
+    number of matches.  The index is rebuilt when the namespace changes size
+    or gets a new last inserted name, which catches the names added or
+    removed by the code run between two completions; matches which are no
+    longer in the namespace are dropped at lookup time.
+    """
+
+    def __init__(self):
+        self._namespace = None
+        self._signature = None
+        self._names = []
+        self._fuzzy_index = None
+
+    def _update(self, namespace):
+        signature = keys_signature(namespace)
+        if namespace is not self._namespace or signature != self._signature:
+            self._namespace = namespace
+            self._signature = signature
+            self._names = sorted([key for key in _viewkeys(namespace)
+                                  if isinstance(key, (str, unicode))])
+        return self._names
+
+    def matches(self, namespace, prefix=''):
+        """Return the sorted names of 'namespace' starting with 'prefix'."""
+        names = self._update(namespace)
+        return [name for name in names[_prefix_slice(names, prefix)]
+                if name in namespace]
+
+    def fuzzy_scored(self, namespace, query):
+        """
+        Return (-score, name) for the names of 'namespace' which fuzzy-match
+        'query', unsorted (see FuzzyIndex.scored()).
+        """
+        names = self._update(namespace)
+        index = self._fuzzy_index
+        if index is None or index.names is not names:
+            index = self._fuzzy_index = FuzzyIndex(names)
+        return [item for item in index.scored(query) if item[1] in namespace]
+
+
+def _filter_private(words, attr):
+    """
+    Return the names in 'words' starting with 'attr', hiding the ones
+    starting with '_' (or '__') unless 'attr' does, or nothing else matches.
+    """
+    found = []
+    n = len(attr)
+    if attr == '':
+        noprefix = '_'
+    elif attr == '_':
+        noprefix = '__'
+    else:
+        noprefix = None
+    while True:
+        for word in words:
+            if (word[:n] == attr and
+                    not (noprefix and word[:n+1] == noprefix)):
+                found.append(word)
+        if found or not noprefix:
+            break
+        if noprefix == '_':
+            noprefix = '__'
+        else:
+            noprefix = None
+    return found
+
+
+_word_memo = {}
+
+
+def _word_info(word):
+    """
+    Return the character bitmask of 'word', its lowercase version and the
+    positions where its parts start, e.g. 'v' in get_value or getValue.
+    """
+    try:
+        return _word_memo[word]
+    except KeyError:
+        pass
+    lword = word.lower()
+    mask = 0
+    for c in lword:
+        mask |= 1 << (ord(c) & 63)
+    bounds = [0]
+    for i in range(1, len(word)):
+        if word[i-1] == '_' or (word[i].isupper() and
+                                not word[i-1].isupper()):
+            bounds.append(i)
+    if len(_word_memo) > 100000:
+        _word_memo.clear()
+    info = _word_memo[word] = mask, lword, frozenset(bounds)
+    return info
+
+
+def char_mask(word):
+    """
+    Return a bitmask of the characters of 'word', ignoring the case: if a
+    word does not have all the bits of a query, the query cannot match it.
+    """
+    return _word_info(word)[0]
+
+
+def _is_subsequence(query, word, start):
+    for c in query:
+        start = word.find(c, start) + 1
+        if not start:
+            return False
+    return True
+
+
+def fuzzy_score(query, word):
+    """
+    Return how well 'query' matches 'word' as a case-insensitive
+    subsequence (the higher the better), or None if it does not match.
+    Prefix matches come first; then characters matched at the start of the
+    parts of the name, and consecutive characters, score more.
+    """
+    return _fuzzy_score(query.lower(), word, _word_info(word))
+
+
+def _fuzzy_score(lquery, word, info):
+    _, lword, bounds = info
+    if lword.startswith(lquery):
+        return 1000 - len(word)
+    score = 0
+    pos = 0
+    prev = -1
+    find = lword.find
+    for k, c in enumerate(lquery):
+        i = find(c, pos)
+        if i < 0:
+            return None
+        if i in bounds:
+            score += 10
+        else:
+            # prefer a later match at a boundary, if the rest still matches
+            j = find(c, i + 1)
+            while j >= 0 and j not in bounds:
+                j = find(c, j + 1)
+            if j >= 0 and _is_subsequence(lquery[k+1:], lword, j + 1):
+                i = j
+                score += 10
+        if i == prev + 1:
+            score += 5
+        score -= i - pos
+        pos = i + 1
+        prev = i
+    return score - len(word) // 4
+
+
+def fuzzy_matches(query, words):
+    """
+    Return the names in the sorted list 'words' which fuzzy-match 'query',
+    best first (see FuzzyIndex.scored()); the names starting with '_' are
+    skipped.
+    """
+    scored = FuzzyIndex(words).scored(query)
+    scored.sort()
+    return [word for _, word in scored]
+
+
+def _fuzzy_scored(query, words):
+    lquery = query.lower()
+    qmask = char_mask(lquery)
+    get_info = _word_memo.get
+    scored = []
+    for word in words:
+        if word[:1] == '_':
+            continue
+        info = get_info(word)
+        if info is None:
+            info = _word_info(word)
+        if info[0] & qmask != qmask:
+            continue
+        score = _fuzzy_score(lquery, word, info)
+        if score is not None:
+            scored.append((-score, word))
+    return scored
+
+
+class FuzzyIndex(object):
+    """
+    Index of a sorted list of names for fuzzy matching.
+
+    For each character, the names which contain it are stored as a big int
+    with one byte per name, computed at the first query which uses it: the
+    candidates of a query are found with a few ANDs of such ints, without
+    looking at the names one by one.  At most 'max_ranked' matches are
+    ranked: when a query matches more names than that, the names starting
+    with it and then the shortest ones, which score best, are kept.
+    """
+
+    max_ranked = 300
+
+    def __init__(self, names):
+        self.names = names
+        self._by_len = None
+        self._char_sets = {}
+
+    def _char_set(self, c):
+        found = self._char_sets.get(c)
+        if found is None:
+            by_len = self._by_len
+            if by_len is None:
+                by_len = self._by_len = sorted(self.names, key=len)
+                lowered = '\n'.join(by_len).lower().split('\n')
+                if len(lowered) != len(by_len):  # names with newlines
+                    lowered = [name.lower() for name in by_len]
+                self._lowered = lowered
+            found = self._char_sets[c] = _bytes_to_int(
+                bytearray(imap(contains, self._lowered, repeat(c))))
+        return found
+
+    def candidates(self, query):
+        """
+        Return the names which contain all the characters of 'query',
+        ignoring the case, shortest first.
+        """
+        found = -1
+        for c in set(query.lower()):
+            found &= self._char_set(c)
+            if not found:
+                return []
+        return list(compress(self._by_len, bytearray(
+            _int_to_bytes(found, len(self._by_len)))))
+
+    def scored(self, query):
+        """
+        Return (-score, name) for at most max_ranked names which fuzzy-match
+        'query' (see fuzzy_score()), unsorted; the names starting with '_'
+        are skipped.
+        """
+        candidates = self.candidates(query)
+        if len(candidates) <= self.max_ranked:
+            return _fuzzy_scored(query, candidates)
+        lo = bisect_left(self.names, query)
+        scored = _fuzzy_scored(query, [
+            word for word in self.names[lo:lo + self.max_ranked]
+            if word.startswith(query)])
+        seen = set(word for _, word in scored)
+        # much cheaper than scoring the candidates which do not match
+        is_match = re.compile('.*?'.join(map(re.escape, query)),
+                              re.IGNORECASE | re.DOTALL).search
+        start = 0
+        size = self.max_ranked
+        while len(scored) < self.max_ranked and start < len(candidates):
+            chunk = candidates[start:start + size]
+            chunk = [word for word in compress(chunk, imap(is_match, chunk))
+                     if word not in seen]
+            scored.extend(_fuzzy_scored(query, chunk))
+            start += size
+            size *= 2
+        return scored[:self.max_ranked]
+
+
+class _AttrContext(object):
+    """
+    What the last call to attr_matches computed, so that the next one can
+    narrow it down instead of starting from scratch while the user keeps
+    typing the name of the attribute.
+    """
+
+    def __init__(self, expr, obj, attr, signature, words):
+        self.expr = expr
+        self.obj = obj
+        self.attr = attr
+        self.signature = signature
+        self.words = words  # all the names starting with attr
+        self.values = {}
+
+    def narrows(self, expr, obj, attr, signature):
+        # only while the user keeps typing on the same line (see
+        # Completer._start_line()): the same text again is a new request
+        return (expr == self.expr and obj is self.obj and
+                attr != self.attr and attr.startswith(self.attr) and
+                signature == self.signature)
+
+
+class _Unsupported(Exception):
+    pass
+
+
+def _literal(node):
+    import ast
+    if node is None:
+        return None
+    return ast.literal_eval(node)
+
+
+def _subscript_step(node):
+    import ast
+    if isinstance(node, getattr(ast, 'Index', ())):  # Python < 3.9
+        node = node.value
+    if isinstance(node, ast.Name):
+        return ('item_name', node.id)
+    if isinstance(node, ast.Slice):
+        return ('item', slice(_literal(node.lower), _literal(node.upper),
+                              _literal(node.step)))
+    return ('item', _literal(node))
+
+
+def _path_steps(node):
+    import ast
+    if isinstance(node, ast.Name):
+        return [('name', node.id)]
+    if isinstance(node, ast.Attribute):
+        return _path_steps(node.value) + [('attr', node.attr)]
+    if isinstance(node, ast.Subscript):
+        return _path_steps(node.value) + [_subscript_step(node.slice)]
+    try:
+        return [('const', _literal(node))]
+    except ValueError:
+        raise _Unsupported
+
+
+_path_cache = {}
+
+
+def parse_path(expr):
+    """
+    Parse an expression like ``a.b[0].c['key']`` into a tuple of steps which
+    can be followed without eval(), or return None if the expression is
+    anything else than names, attributes, literals and subscripts by
+    literals or names.  The result is cached.
+    """
+    try:
+        return _path_cache[expr]
+    except KeyError:
+        pass
+    import ast
+    try:
+        steps = tuple(_path_steps(ast.parse(expr.strip(), mode='eval').body))
+    except (SyntaxError, ValueError, TypeError, _Unsupported):
+        steps = None
+    if len(_path_cache) >= 1000:
+        _path_cache.clear()
+    _path_cache[expr] = steps
+    return steps
+
+
+def lookup_name(namespace, name):
+    """Look up a global name like eval() would, without eval()."""
+    try:
+        return namespace[name]
+    except KeyError:
+        pass
+    try:
+        return builtins.__dict__[name]
+    except KeyError:
+        raise NameError("name %r is not defined" % (name,))
+
+
+class PathResolver(object):
+    """
+    Follow the steps returned by parse_path with plain getattr and getitem.
+
+    The intermediate objects are memoized until reset() is called, so that
+    completing ``a.b.c.<TAB>`` and then ``a.b.c.d<TAB>`` looks up a.b.c only
+    once.  The memo is discarded anyway when the root name gets rebound, and
+    subscripts by names are memoized by the value of the name.
+    """
+
+    def __init__(self):
+        self._memo = {}
+        self.hits = 0
+
+    def reset(self):
+        self._memo.clear()
+
+    def _remember(self, key, obj):
+        try:
+            self._memo[key] = obj
+        except TypeError:  # unhashable literal
+            pass
+
+    def resolve(self, steps, namespace):
+        kind, arg = steps[0]
+        if kind == 'name':
+            obj = lookup_name(namespace, arg)
+        else:
+            obj = arg
+        memo = self._memo
+        try:
+            if memo.get(steps[:1], _missing) is not obj:
+                memo.clear()
+        except TypeError:
+            pass
+        self._remember(steps[:1], obj)
+        key = steps[:1]
+        for i in range(1, len(steps)):
+            kind, arg = steps[i]
+            if kind == 'item_name':
+                # memoized by the value of the name, which can change
+                arg = lookup_name(namespace, arg)
+                key += (('item', arg),)
+            else:
+                key += (steps[i],)
+            try:
+                obj = memo[key]
+                self.hits += 1
+                continue
+            except (KeyError, TypeError):
+                pass
+            if kind == 'attr':
+                obj = getattr(obj, arg)
+            else:
+                obj = obj[arg]
+            self._remember(key, obj)
+        return obj
+
+
+_KEY_RE = None
+_NUMBER_RE = None
+
+
+def _subscript_target(line):
+    """
+    Return the expression at the end of 'line', e.g. ``cfg['db']`` for
+    ``print(cfg['db']``.
+    """
+    i = len(line)
+    depth = 0
+    while i > 0:
+        c = line[i-1]
+        if depth:
+            if c == ']':
+                depth += 1
+            elif c == '[':
+                depth -= 1
+        elif c == ']':
+            depth = 1
+        elif not (c.isalnum() or c in '_.'):
+            break
+        i -= 1
+    return line[i:]
+
+
+def _quote_key(key, quote):
+    """
+    Return the string 'key' as it must be typed between two 'quote's, or
+    None if it cannot be typed on a single line.
+    """
+    if '\n' in key or '\r' in key:
+        return None
+    if '\\' in key:
+        key = key.replace('\\', '\\\\')
+    if quote in key:
+        key = key.replace(quote, '\\' + quote)
+    return key
+
+
+class KeyIndex(object):
+    """
+    Cache of the sorted keys of the last few mappings completed, which are
+    kept alive by it until clear() is called, at each new input line (see
+    Completer._start_line()).
+
+    An entry is valid as long as it is for the very same object and its
+    len() did not change; only the first 'max_keys' keys are indexed, so
+    that huge mappings cost a bounded time even the first time.
+    """
+
+    size = 8
+
+    def __init__(self):
+        self._entries = []  # [obj, len, str keys, reprs], most recent last
+
+    def clear(self):
+        del self._entries[:]
+
+    def _get_keys(self, obj, max_keys):
+        from itertools import islice
+        hook = getattr(type(obj), '_ipython_key_completions_', None)
+        if hook is not None:
+            keys = hook(obj)
+        elif isinstance(obj, dict):
+            keys = obj
+        else:
+            try:
+                from collections.abc import Mapping
+            except ImportError:  # Python 2
+                from collections import Mapping
+            if not isinstance(obj, Mapping):
+                return None
+            keys = obj.keys()
+        return list(islice(keys, max_keys))
+
+    def _entry(self, obj, max_keys):
+        try:
+            size = len(obj)
+        except Exception:
+            size = None
+        for i, entry in enumerate(self._entries):
+            if entry[0] is obj:
+                del self._entries[i]
+                if size is not None and entry[1] == size:
+                    self._entries.append(entry)
+                    return entry
+                break
+        keys = self._get_keys(obj, max_keys)
+        if keys is None:
+            return None
+        strings = sorted(set([key for key in keys
+                              if isinstance(key, (str, unicode))]))
+        entry = [obj, size, strings, keys]
+        if size is not None:
+            self._entries.append(entry)
+            del self._entries[:-self.size]
+        return entry
+
+    def strings(self, obj, prefix, max_keys):
+        """
+        Return the sorted string keys of 'obj' starting with 'prefix', or
+        None if the keys of 'obj' cannot be completed.
+        """
+        entry = self._entry(obj, max_keys)
+        if entry is None:
+            return None
+        strings = entry[2]
+        return strings[_prefix_slice(strings, prefix)]
+
+    def reprs(self, obj, prefix, max_keys):
+        """
+        Like strings(), but return the repr of all the keys which are
+        literals, e.g. ``'name'`` and ``42``.
+        """
+        entry = self._entry(obj, max_keys)
+        if entry is None:
+            return None
+        if not isinstance(entry[3], tuple):
+            reprs = set()
+            for key in entry[3]:
+                if isinstance(key, (str, unicode, bytes, int, float)):
+                    reprs.add(repr(key))
+            entry[3] = tuple(sorted(reprs))
+        reprs = entry[3]
+        return list(reprs[_prefix_slice(reprs, prefix)])
+
+
+def usage_context(obj):
+    """
+    Return the key under which the completions of the attributes of 'obj'
+    are counted: the module name, or the qualified name of the class.
+    """
+    if isinstance(obj, types.ModuleType):
+        return getattr(obj, '__name__', None)
+    if not isinstance(obj, type):
+        obj = type(obj)
+    return '%s.%s' % (getattr(obj, '__module__', None),
+                      getattr(obj, '__qualname__', obj.__name__))
+
+
+class UsageIndex(object):
+    """
+    How many times each name was completed, per context (see
+    usage_context(); None is the global namespace).
+
+    The file is loaded at the first use.  Only the counts added by this
+    process are merged into it by save(), so that parallel sessions don't
+    lose each other's counts.  At most 'max_contexts' contexts of at most
+    'max_names' names are kept, dropping the least recently used contexts
+    and the least completed names.
+    """
+
+    max_contexts = 1000
+    max_names = 100
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._data = None  # {context: {name: [count, last use]}}
+        self._added = {}
+
+    def _load(self):
+        if self._data is None:
+            self._data = read_json_cache(self.filename)
+        return self._data
+
+    def record(self, context, name):
+        """Count a completion of 'name' in 'context'."""
+        import time
+        key = '' if context is None else str(context)
+        now = int(time.time())
+        for data in (self._load(), self._added):
+            usage = data.setdefault(key, {})
+            entry = usage.setdefault(name, [0, 0])
+            entry[0] += 1
+            entry[1] = now
+
+    def rank(self, context, names):
+        """
+        Return the indexes of 'names' sorted by decreasing usage (stable), or
+        None if none of them was ever completed in 'context'.
+        """
+        key = '' if context is None else str(context)
+        usage = self._load().get(key)
+        if not usage:
+            return None
+        counts = [usage.get(name, (0,))[0] for name in names]
+        if not any(counts):
+            return None
+        return sorted(range(len(names)), key=lambda i: -counts[i])
+
+    def _prune(self, data):
+        def last_use(usage):
+            return max(entry[1] for entry in usage.values())
+
+        for key, usage in list(data.items()):
+            if len(usage) > self.max_names:
+                names = sorted(usage, key=lambda name: (usage[name][0],
+                                                        usage[name][1]))
+                for name in names[:len(usage) - self.max_names]:
+                    del usage[name]
+        if len(data) > self.max_contexts:
+            keys = sorted(data, key=lambda key: last_use(data[key]))
+            for key in keys[:len(data) - self.max_contexts]:
+                del data[key]
+
+    def save(self):
+        """Merge the counts added since the last save into the file."""
+        if self.filename is None or not self._added:
+            return
+        data = read_json_cache(self.filename)
+        for key, added in self._added.items():
+            usage = data.setdefault(key, {})
+            for name, (n, when) in added.items():
+                entry = usage.setdefault(name, [0, 0])
+                entry[0] += n
+                entry[1] = max(entry[1], when)
+        self._prune(data)
+        self._added = {}
+        self._data = data
+        write_json_cache(self.filename, data)
+
+
+_usage_index = None
+
+
+def get_usage_index():
+    """
+    Return the UsageIndex shared by the completers of this process, saved
+    to the cache directory at exit.
+    """
+    global _usage_index
+    if _usage_index is None:
+        import atexit
+        _usage_index = UsageIndex(cache_file_path('usage.json'))
+        atexit.register(_usage_index.save)
+    return _usage_index
+
+
+_IMPORT_RE = None
+_FROM_IMPORT_RE = None
+_module_suffixes = None
+
+
+def _is_identifier(name):
+    isidentifier = getattr(name, 'isidentifier', None)
+    if isidentifier is not None:
+        return isidentifier()
+    import re
+    return re.match(r'[A-Za-z_]\w*$', name) is not None  # Python 2
+
+
+def scan_modules(path):
+    """
+    Return the names of the modules and packages in the directory 'path'.
+    """
+    global _module_suffixes
+    if _module_suffixes is None:
+        try:
+            from importlib.machinery import all_suffixes
+            suffixes = all_suffixes()
+        except ImportError:  # Python 2
+            import imp
+            suffixes = [suffix for suffix, _, _ in imp.get_suffixes()]
+        # longest first, e.g. '.cpython-311-x86_64-linux-gnu.so' before '.so'
+        _module_suffixes = sorted(set(suffixes), key=len, reverse=True)
+    names = set()
+    for entry in os.listdir(path):
+        if '.' not in entry:
+            if (entry != '__pycache__' and _is_identifier(entry) and
+                    os.path.isdir(os.path.join(path, entry))):
+                if PY3K or os.path.exists(os.path.join(path, entry,
+                                                       '__init__.py')):
+                    names.add(entry)
+            continue
+        for suffix in _module_suffixes:
+            if entry.endswith(suffix):
+                name = entry[:-len(suffix)]
+                if _is_identifier(name) and name != '__init__':
+                    names.add(name)
+                break
+    return sorted(names)
+
+
+class ModuleIndex(object):
+    """
+    Names of the modules which can be imported, found without importing
+    anything.
+
+    The modules of each directory of sys.path, or of a package, are cached
+    together with the mtime of the directory, which changes when files are
+    added or removed: only the directories which changed are scanned again.
+    The cache is saved to 'filename' when it changes.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._dirs = None  # {path: [mtime, names]}
+        self._dirty = False
+        self._memo = {}  # {package: (key, names)}
+
+    def save(self):
+        if self.filename is not None and self._dirty:
+            self._dirty = False
+            write_json_cache(self.filename, self._dirs)
+
+    def _mtime(self, path):
+        try:
+            return _stat_key(os.stat(path))[0]
+        except OSError:
+            return None
+
+    def dir_modules(self, path, mtime=None):
+        """Return the sorted names of the modules in the directory 'path'."""
+        if self._dirs is None:
+            self._dirs = read_json_cache(self.filename)
+        if mtime is None:
+            mtime = self._mtime(path)
+            if mtime is None:
+                return []
+        entry = self._dirs.get(path)
+        if entry is not None and entry[0] == mtime:
+            return entry[1]
+        try:
+            names = scan_modules(path)
+        except OSError:
+            return []
+        self._dirs[path] = [mtime, names]
+        self._dirty = True
+        return names
+
+    def _package_dirs(self, package):
+        module = sys.modules.get(package)
+        if module is not None:
+            return list(getattr(module, '__path__', None) or [])
+        parts = package.split('.')
+        result = []
+        for entry in sys.path:
+            path = os.path.join(entry or os.curdir, *parts)
+            if os.path.isdir(path):
+                result.append(path)
+        return result
+
+    def modules(self, package=None):
+        """
+        Return the sorted names of the top-level modules, or of the
+        submodules of 'package'.
+        """
+        names = set()
+        if package is None:
+            dirs = [os.path.abspath(entry or os.curdir) for entry in sys.path]
+            names.update(sys.builtin_module_names)
+            prefix = ''
+        else:
+            dirs = self._package_dirs(package)
+            prefix = package + '.'
+        mtimes = [self._mtime(path) for path in dirs]
+        key = (dirs, mtimes, len(sys.modules))
+        memo = self._memo.get(package)
+        if memo is not None and memo[0] == key:
+            return memo[1]
+        for path, mtime in izip(dirs, mtimes):
+            if mtime is not None:
+                names.update(self.dir_modules(path, mtime))
+        # e.g. the modules imported from zip files, or os.path
+        n = len(prefix)
+        for name in list(sys.modules):
+            if name.startswith(prefix) and '.' not in name[n:]:
+                names.add(name[n:])
+        self.save()
+        names = sorted(names)
+        if len(self._memo) > 100:
+            self._memo.clear()
+        self._memo[package] = key, names
+        return names
+
+
+_module_index = None
+
+
+def get_module_index():
+    """Return the ModuleIndex shared by the completers of this process."""
+    global _module_index
+    if _module_index is None:
+        _module_index = ModuleIndex(
+            cache_file_path('modules.%s.json' % _cache_tag()))
+    return _module_index
+
+
+def module_version(module):
+    """
+    Return a string which changes with each version of 'module': its
+    __version__, or the mtime of its file; None if there is none.
+    """
+    version = getattr(module, '__version__', None)
+    if isinstance(version, (str, unicode)):
+        return version
+    filename = getattr(module, '__file__', None)
+    if isinstance(filename, (str, unicode)):
+        try:
+            return 'mtime %d' % _stat_key(os.stat(filename))[0]
+        except OSError:
+            return None
+    if getattr(module, '__name__', None) in sys.builtin_module_names:
+        return 'builtin'
+    return None
+
+
+class ModuleCache(object):
+    """
+    The attribute names of modules and the colors of their values, saved
+    across sessions.
+
+    Entries are keyed by the module name and version, the Python version
+    and the color configuration, so that they never need to be validated.
+    The file is loaded at the first use; save() merges the entries used by
+    this process into it, keeping the 'max_modules' most recently used.
+    """
+
+    def __init__(self, filename, max_modules):
+        self.filename = filename
+        self.max_modules = max_modules
+        self._entries = None
+        self._used = {}
+
+    def key(self, module, fingerprint):
+        """Return the key of the entry of 'module', or None."""
+        version = module_version(module)
+        if version is None:
+            return None
+        return '%s %s %s %s' % (module.__name__, version, _cache_tag(),
+                                fingerprint)
+
+    def get(self, key):
+        """
+        Return the entry for 'key': a dict with the 'keys' signature of the
+        __dict__ of the module when its 'names' were computed, and the
+        'colors' of the names looked up so far.
+        """
+        import time
+        if self._entries is None:
+            self._entries = read_json_cache(self.filename)
+        entry = self._entries.get(key)
+        if not isinstance(entry, dict):
+            entry = self._entries[key] = {'keys': None, 'names': None,
+                                          'colors': {}}
+        entry['used'] = int(time.time())
+        self._used[key] = entry
+        return entry
+
+    def save(self):
+        if self.filename is None or not self._used:
+            return
+        data = read_json_cache(self.filename)
+        data.update(self._used)
+        if len(data) > self.max_modules:
+            keys = sorted(data, key=lambda key: data[key].get('used', 0))
+            for key in keys[:len(data) - self.max_modules]:
+                del data[key]
+        self._used = {}
+        write_json_cache(self.filename, data)
+
+
+_module_cache = None
+
+
+def get_module_cache(max_modules):
+    """
+    Return the ModuleCache shared by the completers of this process, saved
+    to the cache directory at exit.
+    """
+    global _module_cache
+    if _module_cache is None:
+        import atexit
+        _module_cache = ModuleCache(cache_file_path('module_attrs.json'),
+                                    max_modules)
+        atexit.register(_module_cache.save)
+    return _module_cache
+
+
+class Completion(namedtuple('Completion', 'name kind color type_name')):
+    """
+    A completion returned by Completer.complete_batch(): 'kind' is one of
+    'keyword', 'module', 'class', 'function' and 'value' (None if unknown),
+    'color' is the color code used for it, and 'type_name' the name of the
+    type of the value, if requested.
+    """
+
+    __slots__ = ()
+
+
+def kind_of_type(t):
+    """Return the Completion kind of the values of type 't'."""
+    if issubclass(t, types.ModuleType):
+        return 'module'
+    if issubclass(t, (type, ClassType)):
+        return 'class'
+    for klass in getattr(t, '__mro__', ()):
+        if '__call__' in klass.__dict__:
+            return 'function'
+    return 'value'
+
+
+_keyword_entries = None
+
+
+def keyword_entries():
+    """
+    Return the sorted list of (keyword, completion) pairs, where the
+    completion is decorated in the same way as rlcompleter does.
+    """
+    global _keyword_entries
+    if _keyword_entries is None:
+        import keyword
+        words = keyword.kwlist + getattr(keyword, 'softkwlist', [])
+        entries = []
+        for word in sorted(set(words)):
+            completion = word
+            if sys.version_info >= (3, 6):
+                if word in ('finally', 'try'):
+                    completion = word + ':'
+                elif word not in ('False', 'None', 'True', 'break',
+                                  'continue', 'pass', 'else', '_'):
+                    completion = word + ' '
+            entries.append((word, completion))
+        _keyword_entries = entries
+    return _keyword_entries
+
+
+_keywords_by_completion = None
+_soft_keywords = ()
+
+
+def keyword_of(completion):
+    """
+    Return the keyword which 'completion' comes from (see
+    keyword_entries()), or None.
+    """
+    global _keywords_by_completion, _soft_keywords
+    if _keywords_by_completion is None:
+        import keyword
+        _soft_keywords = frozenset(getattr(keyword, 'softkwlist', ()))
+        _keywords_by_completion = dict((completion, word) for word, completion
+                                       in keyword_entries())
+    return _keywords_by_completion.get(completion)
+
+
+class _Job(object):
+
+    def __init__(self, text, line):
+        import threading
+        self.text = text
+        self.line = line
+        self.done = threading.Event()
+        self.result = None
+        self.partial = None
+
+
+class CompletionWorker(object):
+    """
+    Compute the completions of a Completer in a background thread, so that
+    complete() can stop waiting for slow objects (e.g. RPC proxies) after a
+    timeout.
+
+    When a completion does not finish in time, complete() returns the
+    uncolored matches if they are already known, else nothing; the result
+    computed later is returned by the next completion, if it is of the same
+    text on the same input line, and is discarded otherwise.
+    """
 
-    def setup(self):
-        self.readline, supports_color = self.find_best_readline()
-        if self.use_colors == 'auto':
-            self.use_colors = supports_color
+    def __init__(self, completer):
+        import threading
+        self._completer = weakref.ref(completer)
+        self._cond = threading.Condition()
+        self._queue = []
+        self._jobs = {}  # (text, line) -> pending or running job
+        self._timed_out = None  # key of the last completion, if it timed out
+        self._late = None  # (key, result) computed after the timeout
+        self.current = None
+        self._thread = threading.Thread(target=self._run,
+                                        name='fancycompleter-worker')
+        self._thread.daemon = True
+
+    def complete(self, text, timeout, line=None):
+        """
+        Return the matches for 'text', waiting at most 'timeout' seconds.
+        'line' identifies the input line (see Completer._line_state()).
+        """
+        key = text, line
+        with self._cond:
+            late = self._late
+            self._late = self._timed_out = None
+            if late is not None and late[0] == key:
+                return late[1]
+            job = self._jobs.get(key)
+            if job is None:
+                job = self._jobs[key] = _Job(text, line)
+                self._queue.append(job)
+                self._cond.notify()
+            if self._thread.ident is None:
+                self._thread.start()
+        job.done.wait(timeout)
+        with self._cond:
+            if job.done.is_set():
+                return job.result
+            self._timed_out = key
+        return job.partial or []
+
+    def report_partial(self, text, matches):
+        """Called by the completer with the uncolored matches for 'text'."""
+        job = self.current
+        if job is not None and job.text == text:
+            job.partial = matches
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._queue:
+                    if self._completer() is None:
+                        return
+                    self._cond.wait(1.0)
+                job = self.current = self._queue.pop(0)
+            completer = self._completer()
+            if completer is None:
+                return
+            try:
+                with completer._lock:
+                    completer._start_line(job.line)
+                    completer.namespace = completer.get_namespace()
+                    result = completer._compute_matches(job.text)
+            except Exception:
+                result = []
+            del completer
+            with self._cond:
+                job.result = result
+                self.current = None
+                key = job.text, job.line
+                del self._jobs[key]
+                if self._timed_out == key:
+                    # kept for the next completion only
+                    self._late = (key, result)
+                job.done.set()
+
+
+class Stats(object):
+    """
+    Time spent in each phase of the completions, and counters of matches
+    and cache hits.  See Completer.stats().
+    """
 
+    enabled = True
+
+    def __init__(self):
+        self.timers = {}
+        self.counters = {}
+
+    def start(self):
+        return _timer()
+
+    def stop(self, phase, start):
+        """Account the time elapsed since 'start' (see start()) to 'phase'."""
+        elapsed = _timer() - start
+        timer = self.timers.get(phase)
+        if timer is None:
+            timer = self.timers[phase] = [0, 0.0, 0.0]
+        timer[0] += 1
+        timer[1] += elapsed
+        if elapsed > timer[2]:
+            timer[2] = elapsed
+
+    def incr(self, counter, n=1):
+        self.counters[counter] = self.counters.get(counter, 0) + n
+
+    def merge(self, other):
+        """Add the timers and the counters of the Stats 'other'."""
+        for phase, (n, total, maximum) in other.timers.items():
+            timer = self.timers.get(phase)
+            if timer is None:
+                timer = self.timers[phase] = [0, 0.0, 0.0]
+            timer[0] += n
+            timer[1] += total
+            if maximum > timer[2]:
+                timer[2] = maximum
+        for counter, n in other.counters.items():
+            self.incr(counter, n)
+
+    def as_dict(self):
+        phases = {}
+        for phase, (n, total, maximum) in self.timers.items():
+            phases[phase] = {
+                'count': n,
+                'total_ms': total * 1000,
+                'avg_ms': total * 1000 / n,
+                'max_ms': maximum * 1000,
+            }
+        return {'phases': phases, 'counters': dict(self.counters)}
+
+
+class _NullStats(object):
+    """Stats which are not collected, at (almost) no cost."""
+
+    enabled = False
+
+    def start(self):
+        return 0
+
+    def stop(self, phase, start):
+        pass
+
+    def incr(self, counter, n=1):
+        pass
+
+
+class _NullLock(object):
+    """The lock of a Completer which is used only by the readline thread."""
+
+    def acquire(self, blocking=True, timeout=-1):
+        return True
 
-def my_execfile(filename, mydict):
-    with open(filename) as f:
-        code = compile(f.read(), filename, 'exec')
-        exec(code, mydict)
+    def release(self):
+        pass
 
+    def __enter__(self):
+        return self
 
-class ConfigurableClass:
-    DefaultConfig = None
-    config_filename = None
+    def __exit__(self, *exc_info):
+        return False
 
-    def get_config(self, Config):
-        if Config is not None:
-            return Config()
-        # try to load config from the ~/filename file
-        filename = '~/' + self.config_filename
-        rcfile = os.path.normpath(os.path.expanduser(filename))
-        if not os.path.exists(rcfile):
-            return self.DefaultConfig()
 
-        mydict = {}
-        try:
-            my_execfile(rcfile, mydict)
-        except Exception as exc:
-            import traceback
+def _acquire(lock, timeout=None):
+    """
+    Acquire 'lock', waiting at most 'timeout' seconds (forever if None), and
+    return whether it was acquired.
+    """
+    if timeout is None:
+        return lock.acquire()
+    try:
+        return lock.acquire(True, timeout)
+    except TypeError:  # Python 2: no timeout, poll like threading.Condition
+        import time
+        deadline = _timer() + timeout
+        delay = 0.0005
+        while not lock.acquire(False):
+            remaining = deadline - _timer()
+            if remaining <= 0:
+                return False
+            delay = min(delay * 2, remaining, 0.05)
+            time.sleep(delay)
+        return True
 
-            sys.stderr.write("** error when importing %s: %r **\n" % (filename, exc))
-            traceback.print_tb(sys.exc_info()[2])
-            return self.DefaultConfig()
 
-        try:
-            Config = mydict["Config"]
-        except KeyError:
-            return self.DefaultConfig()
+def format_stats(stats):
+    """Format the result of Completer.stats() as a table."""
+    lines = ['fancycompleter stats:']
+    phases = stats['phases']
+    for phase in sorted(phases, key=lambda p: -phases[p]['total_ms']):
+        t = phases[phase]
+        lines.append('  %-10s %8d calls %10.3f ms total %8.3f ms avg '
+                     '%8.3f ms max' % (phase, t['count'], t['total_ms'],
+                                       t['avg_ms'], t['max_ms']))
+    for name, value in sorted(stats['counters'].items()):
+        lines.append('  %-30s %8d' % (name, value))
+    return '\n'.join(lines) + '\n'
+
+
+_stats_refs = None  # weak references to the completers with dumped stats
+_collected_stats = None  # the stats of the ones already garbage collected
 
-        try:
-            return Config()
-        except Exception as exc:
-            err = "error when setting up Config from %s: %s" % (filename, exc)
-            tb = sys.exc_info()[2]
-            if tb and tb.tb_next:
-                tb = tb.tb_next
-                err_fname = tb.tb_frame.f_code.co_filename
-                err_lnum = tb.tb_lineno
-                err += " (%s:%d)" % (err_fname, err_lnum,)
-            sys.stderr.write("** %s **\n" % err)
-        return self.DefaultConfig()
+
+def _register_stats_dump(completer):
+    """
+    Print the stats of 'completer' at exit, added to the ones of the other
+    completers registered here, without keeping it alive for that.
+    """
+    global _stats_refs, _collected_stats
+    if _stats_refs is None:
+        import atexit
+        _stats_refs = set()
+        _collected_stats = Stats()
+        atexit.register(_dump_stats)
+    stats = completer._stats
+    resolver = completer._resolver
+
+    def collected(ref):
+        _stats_refs.discard(ref)
+        _collected_stats.merge(stats)
+        _collected_stats.incr('resolver_memo_hits', resolver.hits)
+
+    _stats_refs.add(weakref.ref(completer, collected))
+
+
+def _dump_stats():
+    total = Stats()
+    total.merge(_collected_stats)
+    # the AttrIndex is usually shared by all the completers
+    attr_indexes = {id(Completer.attr_index): Completer.attr_index}
+    for ref in list(_stats_refs):
+        completer = ref()
+        if completer is None:
+            continue
+        total.merge(completer._stats)
+        total.incr('resolver_memo_hits', completer._resolver.hits)
+        attr_indexes[id(completer.attr_index)] = completer.attr_index
+    if not total.counters.get('completions'):
+        return
+    for index in attr_indexes.values():
+        total.incr('attr_index_hits', index.hits)
+        total.incr('attr_index_misses', index.misses)
+    sys.stderr.write(format_stats(total.as_dict()))
 
 
 class Completer(rlcompleter.Completer, ConfigurableClass):
@@ -239,8 +2247,29 @@ class Completer(rlcompleter.Completer, ConfigurableClass):
     DefaultConfig = DefaultConfig
     config_filename = '.fancycompleterrc.py'
 
+    # shared by all the completers, e.g. the ones of pdb++ sessions
+    attr_index = AttrIndex()
+    key_index = KeyIndex()
+
+    @property
+    def module_index(self):
+        return get_module_index()
+
     def __init__(self, namespace=None, Config=None):
         rlcompleter.Completer.__init__(self, namespace)
+        self._namespace_index = NameIndex()
+        self._builtins_index = NameIndex()
+        self._attr_context = None
+        self._color_signature = None
+        self._color_cache = {}
+        self._color_fingerprint_value = None
+        self._resolver = PathResolver()
+        self._line = None  # see _start_line()
+        self.prefetcher = None
+        self._worker = None
+        self._line_matches = None
+        # serializes the completions of readline and of serve()
+        self._lock = _NullLock()
         self.config = self.get_config(Config)
         self.config.setup()
         readline = self.config.readline
@@ -257,132 +2286,940 @@ class Completer(rlcompleter.Completer, ConfigurableClass):
             delims = delims.replace('[', '')
             delims = delims.replace(']', '')
             readline.set_completer_delims(delims)
+        self.usage_index = None
+        if self.config.rank_by_usage:
+            self.usage_index = get_usage_index()
+        if self.config.prefetch:
+            self.prefetcher = Prefetcher(self, self.config.prefetch_cpu_share)
+            self.prefetcher.start()
+        dump_stats = os.environ.get('FANCYCOMPLETER_STATS')
+        if self.config.collect_stats or dump_stats:
+            self._stats = Stats()
+            if dump_stats:
+                _register_stats_dump(self)
+        else:
+            self._stats = _NullStats()
+
+    def stats(self):
+        """
+        Return the time spent in each phase of the completions done so far
+        ('eval', 'dir', 'filter', 'values', 'color') and the counters of
+        matches and cache hits, or None if the stats are not collected
+        (see DefaultConfig.collect_stats).
+        """
+        if not self._stats.enabled:
+            return None
+        result = self._stats.as_dict()
+        counters = result['counters']
+        counters['attr_index_hits'] = self.attr_index.hits
+        counters['attr_index_misses'] = self.attr_index.misses
+        counters['resolver_memo_hits'] = self._resolver.hits
+        return result
+
+    def get_namespace(self):
+        if self.use_main_ns:
+            import __main__
+            return __main__.__dict__
+        return self.namespace
 
     def complete(self, text, state):
         """
         stolen from:
         http://aspn.activestate.com/ASPN/Cookbook/Python/Recipe/496812
         """
+        if state == 0:
+            self._line_matches = None
+            line = self._line_before_cursor()
+            line_state = self._line_state(line)
+            timeout = self.config.completion_timeout_ms
+            if timeout is not None:
+                timeout /= 1000.0
+                deadline = _timer() + timeout
+            # the lock is held by the worker or the server (see serve()) while
+            # they complete: don't wait for them longer than the timeout
+            if line and _acquire(self._lock, timeout):
+                try:
+                    self._start_line(line_state)
+                    self.namespace = self.get_namespace()
+                    self._line_matches = self.line_matches(line, text)
+                finally:
+                    self._lock.release()
+        if self._line_matches is not None:
+            try:
+                return self._line_matches[state]
+            except IndexError:
+                return None
         if text == "":
             return ['\t', None][state]
-        else:
+        if not text.strip():
             return rlcompleter.Completer.complete(self, text, state)
+        if state == 0:
+            if timeout is None:
+                with self._lock:
+                    self._start_line(line_state)
+                    self.namespace = self.get_namespace()
+                    self.matches = self._compute_matches(text)
+            else:
+                # the worker takes the lock itself
+                if self._worker is None:
+                    self._worker = CompletionWorker(self)
+                self.matches = self._worker.complete(
+                    text, max(deadline - _timer(), 0), line_state)
+        try:
+            match = self.matches[state]
+        except IndexError:
+            return None
+        # render only what readline asks for
+        if type(match) is _Match:
+            return match.render()
+        return match
+
+    def display_matches(self, substitution, matches, longest_match_length):
+        """
+        Completion display hook for GNU readline (see
+        DefaultConfig.self_layout): list the matches of the last completion
+        with layout_matches(), then redraw the prompt and the line.
+        """
+        current = self._line_matches
+        if current is None:
+            current = self.matches
+        try:
+            width = os.get_terminal_size(sys.stdout.fileno()).columns
+        except (AttributeError, ValueError, OSError):
+            width = 80
+        readline = self.config.readline
+        sys.stdout.write('\n' + layout_matches(current, width) +
+                         str(getattr(sys, 'ps1', '')) +
+                         readline.get_line_buffer())
+        sys.stdout.flush()
+        readline.redisplay()
+
+    def _line_state(self, line):
+        """
+        Return what identifies the input line whose text before the cursor
+        is 'line': the length of the history, which grows with each line
+        run, and 'line' itself.  None if readline does not tell.
+        """
+        if line is None:
+            return None
+        try:
+            return self.config.readline.get_current_history_length(), line
+        except Exception:
+            return None
+
+    def _start_line(self, line_state):
+        """
+        Forget the objects resolved and the attribute names and keys listed by
+        the previous completions, unless they were done on the same input line,
+        before the cursor reached its current position: no code can have
+        run in the meantime.  The completions without a 'line_state' (see
+        _line_state()) start from scratch.
+        """
+        previous = self._line
+        self._line = line_state
+        if (line_state is None or previous is None or
+                line_state[0] != previous[0] or
+                not line_state[1].startswith(previous[1])):
+            self._resolver.reset()
+            self._attr_context = None
+            self.key_index.clear()
+
+    def _line_before_cursor(self):
+        readline = self.config.readline
+        try:
+            return readline.get_line_buffer()[:readline.get_endidx()]
+        except Exception:
+            return None
+
+    def line_matches(self, line, text):
+        """
+        Return the completions which depend on the whole line, i.e. module
+        names in import statements and keys in subscripts, or None.
+        """
+        config = self.config
+        matches = None
+        if config.complete_imports:
+            matches = self.import_matches(line, text)
+        if (matches is None and config.complete_keys and
+                config.consider_getitems):
+            matches = self.key_matches(line, text)
+        return matches
+
+    def import_matches(self, line, text):
+        """
+        Complete the module names after ``import`` and ``from``, and the
+        names after ``from module import``, without importing anything.
+        Return None if 'line' is not an import statement.
+        """
+        global _IMPORT_RE, _FROM_IMPORT_RE
+        if _IMPORT_RE is None:
+            import re
+            _IMPORT_RE = re.compile(r'\s*(?:import\s+(?:[\w.]+'
+                                    r'(?:\s+as\s+\w+)?\s*,\s*)*|from\s+)'
+                                    r'([\w.]*)$')
+            _FROM_IMPORT_RE = re.compile(r'\s*from\s+([\w.]+)\s+import\s+'
+                                         r'(?:\(\s*)?(?:\w+(?:\s+as\s+\w+)?'
+                                         r'\s*,\s*)*(\w*)$')
+        match = _IMPORT_RE.match(line)
+        if match is not None:
+            name = match.group(1)
+            package, _, prefix = name.rpartition('.')
+            words = self.module_index.modules(package or None)
+        else:
+            match = _FROM_IMPORT_RE.match(line)
+            if match is None:
+                return None
+            package, prefix = match.groups()
+            words = set(self.module_index.modules(package))
+            module = sys.modules.get(package)
+            if module is not None:
+                words.update(name for name in _dir_words(module)
+                             if not name.startswith('__'))
+            words = sorted(words)
+        if not line.endswith(text) or not text.endswith(prefix):
+            return None
+        self._stats.incr('import_completions')
+        # text is what readline replaces, e.g. 'os.pa' or 'pa'
+        head = text[:len(text) - len(prefix)]
+        names = [head + word for word in words[_prefix_slice(words, prefix)]]
+        names, more = self._truncate(names)
+        if more:
+            names += more + [' ']
+        return names
+
+    def key_matches(self, line, text):
+        """
+        Complete the key of a subscript like ``d['na`` or ``d[`` at the end
+        of 'line', 'text' being the part of it which readline replaces.
+        Return None if 'line' does not end with the subscript of something
+        which has keys.
+        """
+        global _KEY_RE, _NUMBER_RE
+        if _KEY_RE is None:
+            import re
+            _KEY_RE = re.compile(r"""\[\s*(?:(['"])([^'"\\]*)|([-\w.]*))$""")
+            _NUMBER_RE = re.compile(r'-?[0-9]|-$')
+        match = _KEY_RE.search(line)
+        if match is None or not line.endswith(text):
+            return None
+        quote, partial, literal = match.groups()
+        if literal and not _NUMBER_RE.match(literal):
+            return None  # a name, e.g. d[i
+        expr = _subscript_target(line[:match.start()])
+        steps = expr and parse_path(expr)
+        if not steps:
+            return None
+        try:
+            obj = PathResolver().resolve(steps, self.namespace)
+        except Exception:
+            return None
+        max_keys = self.config.max_keys
+        try:
+            if quote:
+                keys = self.key_index.strings(obj, partial, max_keys)
+                closing = quote + ']'
+            else:
+                partial = literal
+                keys = self.key_index.reprs(obj, partial, max_keys)
+                closing = ']'
+        except Exception:
+            return None
+        if keys is None:
+            return None
+        self._stats.incr('key_completions')
+        if quote:
+            keys = [key for key in [_quote_key(key, quote) for key in keys]
+                    if key is not None]
+        if not keys:
+            return []
+        n = len(partial)
+        if len(keys) == 1:
+            return [text + keys[0][n:] + closing]
+        prefix = commonprefix(keys)
+        if len(prefix) > n:
+            return [text + prefix[n:]]
+        keys, more = self._truncate(keys)
+        return keys + more + [' ']
+
+    def _compute_matches(self, text):
+        """
+        Like attr_matches or global_matches, but return _Match records,
+        unless a subclass overrides them: then call them as before.
+        """
+        if '.' in text:
+            if self._overrides('attr_matches'):
+                return self.attr_matches(text)
+            return self._attr_matches(text)
+        if self._overrides('global_matches'):
+            return self.global_matches(text)
+        return self._global_matches(text)
+
+    def _overrides(self, name):
+        """Tell whether a subclass overrides the method 'name'."""
+        # self.__class__, since Completer is an old-style class on Python 2
+        method = getattr(self.__class__, name)
+        method = getattr(method, '__func__', method)
+        return method is not Completer.__dict__[name]
+
+    def _report_partial(self, text, matches):
+        if self._worker is not None:
+            self._worker.report_partial(text, matches)
 
     def _callable_postfix(self, val, word):
         # disable automatic insertion of '(' for global callables:
         # this method exists only in Python 2.6+
         return word
 
-    def global_matches(self, text):
-        import keyword
-        names = rlcompleter.Completer.global_matches(self, text)
-        prefix = commonprefix(names)
-        if prefix and prefix != text:
-            return [prefix]
+    def serve(self, path, block=True):
+        """
+        Answer completion requests on the Unix socket 'path', with one
+        thread per connection (see handle_connection()).  The socket is
+        readable only by the current user.  If 'block' is false, accept the
+        connections in a daemon thread and return it: from then on, the
+        completions of readline wait for the ones of the server.
+        """
+        import socket
+        import stat
+        import tempfile
+        import threading
+        try:
+            if stat.S_ISSOCK(os.stat(path).st_mode):
+                os.remove(path)  # left over by a previous server
+        except OSError:
+            pass
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # bind in a private directory and restrict the permissions there,
+        # instead of changing the umask of the whole process
+        tmpdir = tempfile.mkdtemp(prefix='.fancycompleter-',
+                                  dir=os.path.dirname(os.path.abspath(path)))
+        try:
+            tmppath = os.path.join(tmpdir, 'socket')
+            server.bind(tmppath)
+            os.chmod(tmppath, 0o600)
+            os.rename(tmppath, path)
+        except Exception:
+            server.close()
+            raise
+        finally:
+            try:
+                os.remove(tmppath)
+            except OSError:
+                pass
+            os.rmdir(tmpdir)
+        server.listen(5)
+        if isinstance(self._lock, _NullLock):
+            self._lock = threading.Lock()
+        lock = self._lock
+
+        def accept_loop():
+            try:
+                while True:
+                    conn, _ = server.accept()
+                    thread = threading.Thread(target=handle_connection,
+                                              args=(self, conn, lock))
+                    thread.daemon = True
+                    thread.start()
+            finally:
+                server.close()
+
+        if block:
+            accept_loop()
+            return None
+        thread = threading.Thread(target=accept_loop)
+        thread.daemon = True
+        thread.start()
+        return thread
 
-        names.sort()
+    def complete_batch(self, texts, type_names=False):
+        """
+        Return, for each of 'texts', the list of its Completions: all the
+        matching names, without the readline decorations (ANSI colors,
+        common prefixes, trailing spaces).  The texts on the same
+        expression, e.g. 'os.pa' and 'os.se', share the lookup of the
+        object, of its names and of their values.
+        """
+        self._stats.incr('batch_completions')
+        self.namespace = self.get_namespace()
+        self._check_color_cache()
+        resolver = PathResolver()
+        objects = {}
+        result = []
+        for text in texts:
+            if '.' in text:
+                expr, attr = text.rsplit('.', 1)
+                try:
+                    info = objects[expr]
+                except KeyError:
+                    info = objects[expr] = self._batch_object(expr, resolver)
+                if info is None:
+                    result.append([])
+                else:
+                    result.append(self._batch_attrs(info, attr, type_names))
+            else:
+                result.append(self._batch_globals(text, type_names))
+        return result
+
+    def _batch_object(self, expr, resolver):
+        """Return (obj, sorted names, hints, values) for 'expr', or None."""
+        if '(' in expr or ')' in expr:  # don't call functions
+            return None
+        steps = parse_path(expr)
+        if steps is None:
+            return None
+        try:
+            obj = resolver.resolve(steps, self.namespace)
+        except Exception:
+            return None
+        hints = self._hook_attrs(obj, '')
+        if hints is not None:
+            return obj, sorted(hints), hints, None
+        return obj, self.attr_index.matches(obj), None, {}
+
+    def _batch_attrs(self, info, attr, type_names):
+        obj, words, hints, values = info
+        found = _filter_private(words[_prefix_slice(words, attr)], attr)
+        if self._use_fuzzy(attr):
+            candidates = fuzzy_matches(attr, words)
+            if len(candidates) > len(found):
+                found = candidates
+        if self.config.static_attr_lookup:
+            lookup = static_lookup
+        else:
+            lookup = getattr
+        completions = []
+        for word in found:
+            if hints is not None:
+                hint = hints[word]
+                t = hint if isinstance(hint, type) else None
+                color = self._hint_color(hint)
+            else:
+                try:
+                    value = values[word]
+                except KeyError:
+                    try:
+                        value = lookup(obj, word)
+                    except Exception:
+                        value = None
+                    values[word] = value
+                t = type(value)
+                color = self._color_of_type(t, value)
+            completions.append(self._completion(word, t, color, type_names))
+        return completions
+
+    def _batch_globals(self, text, type_names):
+        names = self.global_names(text)
+        if self._use_fuzzy(text):
+            candidates = self.global_fuzzy_names(text)
+            if len(candidates) > len(names):
+                names = candidates
+        else:
+            names.sort()
+        completions = []
+        for name in names:
+            word = self._keyword_of(name)
+            if word is not None:
+                completions.append(Completion(word, 'keyword', None, None))
+                continue
+            try:
+                value = lookup_name(self.namespace, name)
+            except Exception:
+                completions.append(Completion(name, None, None, None))
+                continue
+            t = type(value)
+            color = self._color_of_type(t, value)
+            completions.append(self._completion(name, t, color, type_names))
+        return completions
+
+    def _keyword_of(self, name):
+        """
+        Return the keyword which the global match 'name' completes, or None
+        if it is the name of a variable.
+        """
+        word = keyword_of(name)
+        if word == name and word in _soft_keywords:
+            # undecorated soft keywords, like '_', may be variables too
+            try:
+                lookup_name(self.namespace, name)
+            except NameError:
+                return word
+            return None
+        return word
+
+    def _completion(self, name, t, color, type_names):
+        if t is None:
+            return Completion(name, None, color, None)
+        return Completion(name, kind_of_type(t), color,
+                          t.__name__ if type_names else None)
+
+    def global_names(self, text):
+        """
+        Return the keywords, names of the namespace and builtins starting
+        with 'text', like rlcompleter.Completer.global_matches does, but
+        looking them up in sorted indexes instead of scanning everything.
+        """
+        seen = set(['__builtins__'])
+        names = []
+        for word, completion in keyword_entries():
+            if word.startswith(text):
+                seen.add(word)
+                names.append(completion)
+        for index, namespace in ((self._namespace_index, self.namespace),
+                                 (self._builtins_index, builtins.__dict__)):
+            for word in index.matches(namespace, text):
+                if word not in seen:
+                    seen.add(word)
+                    names.append(word)
+        return names
+
+    def global_fuzzy_names(self, text):
+        """
+        Return the keywords, names of the namespace and builtins which
+        fuzzy-match 'text', best first.
+        """
+        by_name = dict(keyword_entries())
+        scored = _fuzzy_scored(text, list(by_name))
+        for index, namespace in ((self._namespace_index, self.namespace),
+                                 (self._builtins_index, builtins.__dict__)):
+            for item in index.fuzzy_scored(namespace, text):
+                if item[1] not in by_name:
+                    by_name[item[1]] = item[1]
+                    scored.append(item)
+        scored.sort()
+        return [by_name[word] for _, word in scored]
+
+    def global_matches(self, text):
+        return render_matches(self._global_matches(text))
+
+    def _global_matches(self, text):
+        stats = self._stats
+        stats.incr('completions')
+        stats.incr('global_completions')
+        start = stats.start()
+        names = self.global_names(text)
+        stats.stop('dir', start)
+        start = stats.start()
+        ranked = False
+        if self._use_fuzzy(text):
+            candidates = self.global_fuzzy_names(text)
+            if len(candidates) > len(names):
+                # some of them don't start with text
+                names = candidates
+                ranked = True
+        stats.incr('matches', len(names))
+        if len(names) == 1:
+            self._record_usage(None, names[0])
+        if ranked:
+            if len(names) == 1:
+                stats.stop('filter', start)
+                return names
+        else:
+            prefix = commonprefix(names)
+            if prefix and prefix != text:
+                stats.stop('filter', start)
+                return [prefix]
+            names.sort()
+            order = self._usage_order(None, names)
+            if order is not None:
+                names = [names[i] for i in order]
+        names, more = self._truncate(names)
+        stats.stop('filter', start)
+        if not (self.config.use_colors and names):
+            if ranked:
+                # don't let readline insert the common prefix
+                more = more + [' ']
+            return names + more
+        self._report_partial(text, names + more)
+        start = stats.start()
+        deadline = self._new_deadline()
         values = []
         for name in names:
-            clean_name = name.rstrip(': ')
-            if clean_name in keyword.kwlist:
+            if self._keyword_of(name) is not None:
                 values.append(None)
+            elif deadline.expired():
+                values.append(_unresolved)
             else:
                 try:
-                    values.append(eval(name, self.namespace))
+                    values.append(lookup_name(self.namespace, name))
                 except Exception as exc:
                     values.append(exc)
-        if self.config.use_colors and names:
-            return self.color_matches(names, values)
-        return names
+        stats.stop('values', start)
+        return self._add_more(self._color_records(names, values, deadline),
+                              more)
+
+    def _truncate(self, names):
+        """
+        Return the first config.max_matches names, and a list containing the
+        entry which tells how many were left out, if any.
+        """
+        limit = self.config.max_matches
+        if limit is None or len(names) <= limit:
+            return names, []
+        self._stats.incr('truncated')
+        return names[:limit], ['... %d more' % (len(names) - limit)]
+
+    def _add_more(self, matches, more):
+        if more:
+            # before the trailing ' ', and sorted after the other matches;
+            # a record, so that layout_matches() sees it without the prefix
+            matches.insert(-1, _Match(more[0], None, len(matches) - 1))
+        return matches
 
     def attr_matches(self, text):
+        # a completion on its own, outside of an input line
+        self._start_line(None)
+        return render_matches(self._attr_matches(text))
+
+    def _attr_matches(self, text):
+        stats = self._stats
+        stats.incr('completions')
+        stats.incr('attr_completions')
         expr, attr = text.rsplit('.', 1)
         if '(' in expr or ')' in expr:  # don't call functions
             return []
+        start = stats.start()
+        steps = parse_path(expr)
+        if steps is None:
+            stats.stop('eval', start)
+            return []
         try:
-            thisobject = eval(expr, self.namespace)
+            thisobject = self._resolver.resolve(steps, self.namespace)
         except Exception:
             return []
+        finally:
+            stats.stop('eval', start)
+        if self.prefetcher is not None and steps[0][0] == 'name':
+            self.prefetcher.notify(steps[0][1])
 
         # get the content of the object, except __builtins__
-        words = set(dir(thisobject))
-        words.discard("__builtins__")
-
-        if hasattr(thisobject, '__class__'):
-            words.add('__class__')
-            words.update(rlcompleter.get_class_members(thisobject.__class__))
-        names = []
-        values = []
-        n = len(attr)
-        if attr == '':
-            noprefix = '_'
-        elif attr == '_':
-            noprefix = '__'
+        start = stats.start()
+        fuzzy = self._use_fuzzy(attr)
+        # in fuzzy mode, all the names are candidates
+        hints = self._hook_attrs(thisobject, '' if fuzzy else attr)
+        module_entry = None
+        if hints is not None:
+            words = sorted(hints)
+            context = _AttrContext(expr, thisobject, attr, None, words)
         else:
-            noprefix = None
-        words = sorted(words)
-        while True:
-            for word in words:
-                if (word[:n] == attr and
-                        not (noprefix and word[:n+1] == noprefix)):
-                    try:
-                        val = getattr(thisobject, word)
-                    except Exception:
-                        val = None  # Include even if attribute not set
-
-                    if not PY3K and isinstance(word, unicode):
-                        # this is needed because pyrepl doesn't like unicode
-                        # completions: as soon as it finds something which is not str,
-                        # it stops.
-                        word = word.encode('utf-8')
-
-                    names.append(word)
-                    values.append(val)
-            if names or not noprefix:
-                break
-            if noprefix == '_':
-                noprefix = '__'
-            else:
-                noprefix = None
-
-        if not names:
+            module_entry = self._module_entry(thisobject)
+            words, context = self._attr_words(expr, thisobject,
+                                              '' if fuzzy else attr)
+        stats.stop('dir', start)
+        start = stats.start()
+        found = _filter_private(words[_prefix_slice(words, attr)], attr)
+        ranked = False
+        if fuzzy:
+            candidates = fuzzy_matches(attr, words)
+            if len(candidates) > len(found):
+                # some of them don't start with attr
+                found = candidates
+                ranked = True
+
+        stats.incr('matches', len(found))
+        if not found:
+            stats.stop('filter', start)
             return []
 
+        names = []
+        for word in found:
+            if not PY3K and isinstance(word, unicode):
+                # this is needed because pyrepl doesn't like unicode
+                # completions: as soon as it finds something which is not str,
+                # it stops.
+                word = word.encode('utf-8')
+            names.append(word)
+
         if len(names) == 1:
+            stats.stop('filter', start)
+            self._record_usage(thisobject, found[0], True)
             return ['%s.%s' % (expr, names[0])]  # only option, no coloring.
 
-        prefix = commonprefix(names)
+        if ranked:
+            prefix = ''
+        else:
+            prefix = commonprefix(names)
+        stats.stop('filter', start)
         if prefix and prefix != attr:
             return ['%s.%s' % (expr, prefix)]  # autocomplete prefix
 
+        if not ranked:
+            order = self._usage_order(thisobject, found, True)
+            if order is not None:
+                found = [found[i] for i in order]
+                names = [names[i] for i in order]
+        names, more = self._truncate(names)
         if self.config.use_colors:
-            return self.color_matches(names, values)
-
-        if prefix:
+            self._report_partial(text, names + more + [' '])
+            start = stats.start()
+            deadline = self._new_deadline()
+            words = found[:len(names)]
+            colors = None
+            if hints is not None:
+                # don't look up anything else than what the hook returned
+                colors = [self._hint_color(hints[word]) for word in words]
+                values = [_unresolved] * len(words)
+            elif module_entry is not None:
+                colors = [module_entry['colors'].get(word) for word in words]
+                missing = [word for word, color in izip(words, colors)
+                           if color is None]
+                looked_up = iter(self._attr_values(thisobject, missing,
+                                                   deadline, context.values))
+                values = [_unresolved if color is not None else next(looked_up)
+                          for color in colors]
+                self._store_colors(module_entry, words, values)
+            else:
+                values = self._attr_values(thisobject, words, deadline,
+                                           context.values)
+            stats.stop('values', start)
+            matches = self._color_records(names, values, deadline, colors)
+            return self._add_more(matches, more)
+
+        names += more
+        if prefix or ranked:
             names += [' ']
         return names
 
-    def color_matches(self, names, values):
-        matches = [self.color_for_obj(i, name, obj)
-                   for i, name, obj
-                   in izip(count(), names, values)]
+    def _hook_attrs(self, obj, prefix):
+        """
+        Call the __fancycompleter_attrs__(prefix) method of the class of
+        'obj', if any.  It returns the names of the attributes, at least the
+        ones starting with 'prefix', or (name, hint) pairs where the hint is
+        a color (see Color) or the type of the value, in a single call: this
+        is meant for proxies of remote objects, where dir() and each getattr
+        are a round-trip.  Return {name: hint}, or None.
+        """
+        hook = getattr(type(obj), '__fancycompleter_attrs__', None)
+        if hook is None:
+            return None
+        try:
+            result = {}
+            for item in hook(obj, prefix):
+                if isinstance(item, (str, unicode)):
+                    result[item] = None
+                else:
+                    name, hint = item
+                    result[name] = hint
+        except Exception:
+            return None  # fall back to dir()
+        self._stats.incr('attrs_hook_calls')
+        return result
+
+    def _hint_color(self, hint):
+        if isinstance(hint, type):
+            self._check_color_cache()
+            return self._color_of_type(hint)
+        if isinstance(hint, (str, unicode)):
+            return hint
+        return None
+
+    def _module_entry(self, obj):
+        """
+        Return the ModuleCache entry of the module 'obj', after seeding the
+        AttrIndex with its names, or None.
+        """
+        if not (self.config.module_cache and
+                isinstance(obj, types.ModuleType)):
+            return None
+        cache = get_module_cache(self.config.module_cache_size)
+        try:
+            key = cache.key(obj, self._color_fingerprint())
+        except Exception:
+            return None
+        if key is None:
+            return None
+        entry = cache.get(key)
+        keys = entry.get('keys')
+        if not (keys and entry.get('names') is not None and
+                self.attr_index.seed(obj, tuple(keys), entry['names'])):
+            signature = keys_signature(obj.__dict__)
+            if (isinstance(signature, tuple) and
+                    self.attr_index.signature(obj) is not None):
+                entry['keys'] = list(signature)
+                entry['names'] = self.attr_index.matches(obj)
+        return entry
+
+    def _color_fingerprint(self):
+        self._check_color_cache()
+        if self._color_fingerprint_value is None:
+            from hashlib import sha1
+            config = self.config
+            items = sorted('%s.%s %s' % (getattr(t, '__module__', ''),
+                                         getattr(t, '__name__', t), color)
+                           for t, color in config.color_by_type.items())
+            items += ['%s.%s %s' % (getattr(t, '__module__', ''),
+                                    getattr(t, '__name__', t), color)
+                      for t, color in config.color_by_baseclass]
+            digest = sha1('\n'.join(items).encode('utf-8')).hexdigest()
+            self._color_fingerprint_value = digest[:12]
+        return self._color_fingerprint_value
+
+    def _store_colors(self, entry, words, values):
+        colors = entry['colors']
+        for word, value in izip(words, values):
+            if value is not _unresolved:
+                colors[word] = self._color_of(value)
+
+    def _record_usage(self, obj, name, is_attr=False):
+        if self.usage_index is not None:
+            context = usage_context(obj) if is_attr else None
+            self.usage_index.record(context, name)
+
+    def _usage_order(self, obj, names, is_attr=False):
+        if self.usage_index is None:
+            return None
+        context = usage_context(obj) if is_attr else None
+        return self.usage_index.rank(context, names)
+
+    def _use_fuzzy(self, text):
+        # names starting with '_' are completed only by prefix, and so are
+        # single characters, which would match most of the names
+        return (self.config.fuzzy_matching and len(text) >= 2 and
+                not text.startswith('_'))
+
+    def _attr_words(self, expr, thisobject, prefix):
+        """
+        Return the sorted names of 'thisobject' starting with 'prefix', and
+        the _AttrContext they come from.
+        """
+        signature = self.attr_index.signature(thisobject)
+        context = self._attr_context
+        if (context is not None and
+                context.narrows(expr, thisobject, prefix, signature)):
+            self._stats.incr('narrowed')
+            words = context.words[_prefix_slice(context.words, prefix)]
+        else:
+            words = self.attr_index.matches(thisobject, prefix)
+            context = None
+        new_context = _AttrContext(expr, thisobject, prefix, signature,
+                                   words)
+        if context is not None:
+            new_context.values = context.values
+        self._attr_context = new_context
+        return words, new_context
+
+    def _attr_values(self, thisobject, words, deadline, cache):
+        if self.config.static_attr_lookup:
+            lookup = static_lookup
+        else:
+            lookup = getattr
+        values = []
+        for word in words:
+            val = cache.get(word, _unresolved)
+            if val is not _unresolved:
+                self._stats.incr('values_cached')
+            elif not deadline.expired():
+                try:
+                    val = lookup(thisobject, word)
+                except Exception:
+                    val = None  # Include even if attribute not set
+                cache[word] = val
+            values.append(val)
+        return values
+
+    def _new_deadline(self):
+        return _Deadline(self.config.completion_budget_ms)
+
+    def color_matches(self, names, values, deadline=None, colors=None):
+        return render_matches(self._make_color_records(names, values,
+                                                       deadline, colors))
+
+    def _color_records(self, names, values, deadline=None, colors=None):
+        """
+        Like color_matches(), but return _Match records, unless a subclass
+        overrides it: then call it as before, with None for the values
+        which were not looked up.
+        """
+        if self._overrides('color_matches'):
+            return self.color_matches(names, [None if value is _unresolved
+                                              else value
+                                              for value in values])
+        return self._make_color_records(names, values, deadline, colors)
+
+    def _make_color_records(self, names, values, deadline=None,
+                            colors=None):
+        stats = self._stats
+        start = stats.start()
+        if deadline is None:
+            deadline = self._new_deadline()
+        self._check_color_cache()
+        color_of = self._color_of
+        color_for_obj = None
+        if self._overrides('color_for_obj'):
+            color_for_obj = self.color_for_obj
+        matches = []
+        for i, name, obj in izip(count(), names, values):
+            if colors is not None and colors[i] is not None:
+                # already known, e.g. from the ModuleCache
+                color = colors[i]
+            elif obj is _unresolved or deadline.expired():
+                # out of time: don't color it
+                color = None
+            elif color_for_obj is not None:
+                matches.append(color_for_obj(i, name, obj))
+                continue
+            else:
+                color = color_of(obj)
+            matches.append(_Match(name, color, i))
+        stats.stop('color', start)
         # We add a space at the end to prevent the automatic completion of the
         # common prefix, which is the ANSI ESCAPE sequence.
         return matches + [' ']
 
-    def color_for_obj(self, i, name, value):
-        t = type(value)
+    def _check_color_cache(self):
+        config = self.config
+        signature = (id(config.color_by_type), len(config.color_by_type),
+                     id(config.color_by_baseclass),
+                     len(config.color_by_baseclass))
+        if signature != self._color_signature:
+            self._color_signature = signature
+            self._color_cache = {}
+            self._color_fingerprint_value = None
+
+    def classify_values(self, obj):
+        """
+        Fill the color cache with the types of the values in the __dict__ of
+        the module or class 'obj'.
+        """
+        self._check_color_cache()
+        for value in list(_static_dict(obj).values()):
+            self._color_of(value)
+
+    def _color_of(self, value):
+        return self._color_of_type(type(value), value)
+
+    def _color_of_type(self, t, value=_missing):
+        try:
+            return self._color_cache[t]
+        except (KeyError, TypeError):
+            pass
+        self._stats.incr('color_cache_misses')
+        cacheable = True
         color = self.config.color_by_type.get(t, None)
         if color is None:
             for x, _color in self.config.color_by_baseclass:
-                if isinstance(value, x):
+                try:
+                    match = issubclass(t, x)
+                except TypeError:
+                    # e.g. protocols which only support isinstance()
+                    match = value is not _missing and isinstance(value, x)
+                    cacheable = False
+                if match:
                     color = _color
                     break
             else:
                 color = '00'
+        if cacheable:
+            try:
+                self._color_cache[t] = color
+            except TypeError:
+                pass
+        return color
+
+    def color_for_obj(self, i, name, value):
+        self._check_color_cache()
+        color = self._color_of(value)
         # hack: prepend an (increasing) fake escape sequence,
         # so that readline can sort the matches correctly.
-        return '\x1b[%03d;00m' % i + Color.set(color, name)
+        return _Match(name, color, i).render()
 
 
 def commonprefix(names, base=''):
@@ -422,6 +3259,11 @@ def setup():
     else:
         readline.parse_and_bind('tab: complete')
     readline.set_completer(completer.complete)
+    config = completer.config
+    if (config.self_layout and not config.using_pyrepl and
+            hasattr(readline, 'set_completion_display_matches_hook')):
+        readline.set_completion_display_matches_hook(
+            completer.display_matches)
     return completer
 
 
@@ -433,15 +3275,119 @@ def interact_pyrepl():
     run_multiline_interactive_console()
 
 
+def read_history_tail(filename, max_entries):
+    """
+    Return the last 'max_entries' entries of a history file, reading only
+    the end of it, and the number of bytes they take.  Newlines inside
+    entries are stored as '\\r\\n', like pyrepl does.
+    """
+    import re
+    separator = re.compile(br'(?<!\r)\n')
+    with open(filename, 'rb') as f:
+        f.seek(0, 2)
+        pos = f.tell()
+        data = b''
+        while pos > 0:
+            step = min(pos, 65536)
+            pos -= step
+            f.seek(pos)
+            data = f.read(step) + data
+            if data.count(b'\n') - data.count(b'\r\n') > max_entries:
+                break
+    lines = separator.split(data)
+    if lines[-1] == b'':
+        del lines[-1]  # the final newline
+    if pos > 0:
+        del lines[0]  # partial
+    lines = lines[-max_entries:]
+    size = sum(len(line) + 1 for line in lines)
+    entries = []
+    for line in lines:
+        line = line.replace(b'\r\n', b'\n').decode('utf-8', 'replace')
+        if line:
+            entries.append(line)
+    return entries, size
+
+
+class HistoryFile(object):
+    """
+    Append-only persistence of the readline history.
+
+    load() reads only the tail of the file, so that the startup time does
+    not grow with the history; save() appends the entries added since then.
+    When the file gets twice as large as what was loaded, it is compacted
+    down to the last 'max_entries' entries.
+    """
+
+    def __init__(self, readline, filename, max_entries, using_pyrepl=False):
+        self.readline = readline
+        self.filename = filename
+        self.max_entries = max_entries
+        self.using_pyrepl = using_pyrepl
+        self.loaded = 0
+        self.max_size = None
+
+    def load(self):
+        if not os.path.isfile(self.filename):
+            return
+        entries, size = read_history_tail(self.filename, self.max_entries)
+        for entry in entries:
+            self.readline.add_history(entry)
+        self.loaded = self.readline.get_current_history_length()
+        if len(entries) >= self.max_entries:
+            self.max_size = 2 * size
+
+    def save(self):
+        readline = self.readline
+        length = readline.get_current_history_length()
+        n = length - self.loaded
+        if n <= 0:
+            return
+        try:
+            if (hasattr(readline, 'append_history_file') and
+                    not self.using_pyrepl):
+                open(self.filename, 'ab').close()  # it must exist
+                readline.append_history_file(n, self.filename)
+            else:
+                data = []
+                for i in range(self.loaded + 1, length + 1):
+                    entry = readline.get_history_item(i)
+                    if entry is not None:
+                        entry = entry.replace('\n', '\r\n') + '\n'
+                        data.append(entry.encode('utf-8'))
+                with open(self.filename, 'ab') as f:
+                    f.write(b''.join(data))
+            self.loaded = length
+            if (self.max_size is not None and
+                    os.path.getsize(self.filename) > self.max_size):
+                self.compact()
+        except (IOError, OSError):
+            pass
+
+    def compact(self):
+        """Keep only the last 'max_entries' entries in the file."""
+        entries, _ = read_history_tail(self.filename, self.max_entries)
+        data = [(entry.replace('\n', '\r\n') + '\n').encode('utf-8')
+                for entry in entries]
+        write_cache_file(self.filename, b''.join(data))
+
+
 def setup_history(completer, persist_history):
     import atexit
-    readline = completer.config.readline
+    config = completer.config
+    readline = config.readline
     #
     if isinstance(persist_history, (str, unicode)):
         filename = persist_history
     else:
         filename = '~/.history.py'
     filename = os.path.expanduser(filename)
+    if config.history_append:
+        history = HistoryFile(readline, filename, config.history_length,
+                              config.using_pyrepl)
+        history.load()
+        atexit.register(history.save)
+        return history
     if os.path.isfile(filename):
         readline.read_history_file(filename)
 
@@ -523,23 +3469,142 @@ class Installer(object):
             print('    export PYTHONSTARTUP=%s' % self.filename)
 
 
-if __name__ == '__main__':
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+
+
+def encode_frame(obj):
+    """Return the frame of the JSON object 'obj': 4 bytes of length, then
+    the UTF-8 JSON."""
+    import json
+    import struct
+    data = json.dumps(obj, separators=(',', ':')).encode('utf-8')
+    return struct.pack('>I', len(data)) + data
+
+
+def decode_frames(buf):
+    """
+    Return the JSON objects of the complete frames at the start of the
+    bytes 'buf', and the rest of it.
+    """
+    import json
+    import struct
+    objs = []
+    pos = 0
+    while len(buf) - pos >= 4:
+        size, = struct.unpack('>I', buf[pos:pos+4])
+        if size > MAX_FRAME_SIZE:
+            raise ValueError('frame too large: %d bytes' % size)
+        if len(buf) - pos - 4 < size:
+            break
+        objs.append(json.loads(buf[pos+4:pos+4+size].decode('utf-8')))
+        pos += 4 + size
+    return objs, buf[pos:]
+
+
+def serve_request(completer, request):
+    """Return the response to one request of handle_connection()."""
+    if not isinstance(request, dict):
+        return {'id': None, 'error': 'invalid request: not a JSON object'}
+    try:
+        completer.namespace = completer.get_namespace()
+        method = request.get('method', 'complete')
+        if method == 'complete':
+            # the code run by the client between two requests is unknown
+            completer._start_line(None)
+            text = request['text']
+            line = request.get('line')
+            matches = None
+            if line:
+                matches = completer.line_matches(line, text)
+            if matches is None:
+                if text == '':
+                    matches = ['\t']
+                else:
+                    matches = render_matches(
+                        completer._compute_matches(text))
+            response = {'matches': matches}
+        elif method == 'batch':
+            result = completer.complete_batch(request['texts'],
+                                              bool(request.get('type_names')))
+            response = {'completions': [[list(c) for c in completions]
+                                        for completions in result]}
+        else:
+            response = {'error': "unknown method: '%s'" % (method,)}
+    except Exception as exc:
+        response = {'error': '%s: %s' % (type(exc).__name__, exc)}
+    response['id'] = request.get('id')
+    return response
+
+
+def handle_connection(completer, sock, lock=None):
+    """
+    Answer the completion requests read from the socket 'sock' until the
+    other end closes it.
+
+    Each message is a frame (see encode_frame()) holding a JSON object.  A
+    request is either {"id": ..., "method": "complete", "text": ...,
+    "line": ...}, answered by {"id": ..., "matches": [...]} with the
+    strings readline would get (colored, if the config says so), or
+    {"id": ..., "method": "batch", "texts": [...], "type_names": false},
+    answered by {"id": ..., "completions": [[[name, kind, color,
+    type_name], ...], ...]}.  "line" is the line before the cursor, if
+    known.  Errors are answered by {"id": ..., "error": message}.
+
+    Requests can be pipelined: all the ones received together are answered
+    with a single write, in order.  'lock' serializes the use of the
+    completer by several connections.
+    """
+    buf = b''
+    try:
+        while True:
+            data = sock.recv(65536)
+            if not data:
+                break
+            requests, buf = decode_frames(buf + data)
+            if not requests:
+                continue
+            if lock is not None:
+                lock.acquire()
+            try:
+                responses = [encode_frame(serve_request(completer, request))
+                             for request in requests]
+            finally:
+                if lock is not None:
+                    lock.release()
+            sock.sendall(b''.join(responses))
+    except (IOError, OSError, ValueError):
+        pass  # the client went away, or sent garbage
+    finally:
+        sock.close()
+
+
+def main(argv):
     def usage():
         print('Usage: python -m fancycompleter install [-f|--force]')
+        print('       python -m fancycompleter serve PATH')
         sys.exit(1)
 
     cmd = None
     force = False
-    for item in sys.argv[1:]:
-        if item in ('install',):
+    args = []
+    for item in argv:
+        if item in ('install', 'serve') and cmd is None:
             cmd = item
         elif item in ('-f', '--force'):
             force = True
+        elif cmd == 'serve' and not args:
+            args.append(item)
         else:
             usage()
     #
     if cmd == 'install':
         installer = Installer('~', force)
         installer.install()
+    elif cmd == 'serve' and args:
+        Completer().serve(args[0])
     else:
         usage()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -1,3 +1,6 @@
+import json
+import os
+
 import pytest
 
 
@@ -8,6 +11,138 @@ pytest_plugins = ["pytester"]
 def tmphome(tmpdir, monkeypatch):
     monkeypatch.setenv("HOME", str(tmpdir))
     monkeypatch.setenv("USERPROFILE", str(tmpdir))
+    monkeypatch.delenv("XDG_CACHE_HOME", raising=False)
 
     with tmpdir.as_cwd():
         yield tmpdir
+
+
+def pytest_addoption(parser):
+    group = parser.getgroup("fancycompleter benchmarks")
+    group.addoption("--benchmarks", action="store_true",
+                    help="run the benchmarks (skipped by default).")
+    group.addoption("--benchmarks-save", action="store_true",
+                    help="save the results as the new baseline.")
+    group.addoption("--benchmarks-baseline", metavar="PATH",
+                    help="baseline file (default: .benchmarks/baseline.json "
+                    "in the root directory).")
+    group.addoption("--benchmarks-tolerance", type=float, default=1.5,
+                    metavar="FACTOR",
+                    help="fail when the p50 latency of a benchmark is more "
+                    "than FACTOR times the baseline (default: %(default)s).")
+
+
+def pytest_collection_modifyitems(config, items):
+    if config.getoption("--benchmarks"):
+        return
+    skip = pytest.mark.skip(reason="needs --benchmarks")
+    for item in items:
+        if item.get_closest_marker("benchmark") is not None:
+            item.add_marker(skip)
+
+
+class Benchmark(object):
+    """
+    Measure the p50/p99 latency and the peak of memory allocated by a
+    function, and compare them to the baseline.
+    """
+
+    def __init__(self, name, baseline, tolerance):
+        self.name = name
+        self.baseline = baseline
+        self.tolerance = tolerance
+        self.result = None
+
+    def __call__(self, func, rounds=100, setup=None):
+        import tracemalloc
+        from fancycompleter import _timer
+
+        timings = []
+        for i in range(rounds + 1):
+            if setup is not None:
+                setup()
+            start = _timer()
+            func()
+            if i:  # the first round is a warm up
+                timings.append(_timer() - start)
+        timings.sort()
+
+        if setup is not None:
+            setup()
+        tracemalloc.start()
+        try:
+            before = tracemalloc.get_traced_memory()[0]
+            func()
+            peak = tracemalloc.get_traced_memory()[1] - before
+        finally:
+            tracemalloc.stop()
+
+        self.result = {
+            "p50_us": timings[len(timings) // 2] * 1e6,
+            "p99_us": timings[min(len(timings) - 1,
+                                  int(len(timings) * 0.99))] * 1e6,
+            "alloc_kb": peak / 1024.0,
+            "rounds": rounds,
+        }
+        self.check()
+        return self.result
+
+    def check(self):
+        base = self.baseline.get(self.name)
+        if base is None or self.tolerance <= 0:
+            return
+        if self.result["p50_us"] > base["p50_us"] * self.tolerance:
+            pytest.fail("%s: p50 %.1fus, baseline %.1fus" % (
+                self.name, self.result["p50_us"], base["p50_us"]))
+
+
+def _baseline_path(config):
+    path = config.getoption("--benchmarks-baseline")
+    if path is None:
+        path = str(config.rootdir.join(".benchmarks", "baseline.json"))
+    return path
+
+
+def _load_baseline(config):
+    if config.getoption("--benchmarks-save"):
+        return {}
+    path = _baseline_path(config)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+@pytest.fixture
+def bench(request):
+    config = request.config
+    if not hasattr(config, "_benchmark_results"):
+        config._benchmark_results = {}
+        config._benchmark_baseline = _load_baseline(config)
+    bench = Benchmark(request.node.name, config._benchmark_baseline,
+                      config.getoption("--benchmarks-tolerance"))
+    yield bench
+    if bench.result is not None:
+        config._benchmark_results[bench.name] = bench.result
+
+
+def pytest_terminal_summary(terminalreporter, config):
+    results = getattr(config, "_benchmark_results", None)
+    if not results:
+        return
+    tr = terminalreporter
+    tr.section("benchmarks")
+    tr.write_line("%-45s %12s %12s %12s" % ("name", "p50 (us)", "p99 (us)",
+                                            "alloc (KiB)"))
+    for name in sorted(results):
+        r = results[name]
+        tr.write_line("%-45s %12.1f %12.1f %12.1f" % (
+            name, r["p50_us"], r["p99_us"], r["alloc_kb"]))
+    if config.getoption("--benchmarks-save"):
+        path = _baseline_path(config)
+        dirname = os.path.dirname(path)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        with open(path, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        tr.write_line("baseline saved to %s" % path)
@@ -0,0 +1,139 @@
+"""
+Benchmarks of the completion hot paths, on synthetic worst cases.
+
+They are skipped by default: run them with ``pytest --benchmarks``, and
+save the results as the baseline for later runs with ``--benchmarks-save``.
+"""
+import time
+
+import pytest
+
+from fancycompleter import Completer, DefaultConfig, commonprefix
+
+pytestmark = pytest.mark.benchmark
+
+# the fuzzy completion of a short query must stay interactive
+FUZZY_TARGET_US = 5000
+
+
+class PlainConfig(DefaultConfig):
+    use_colors = False
+
+
+class ColorConfig(DefaultConfig):
+    use_colors = True
+
+
+class FuzzyConfig(ColorConfig):
+    fuzzy_matching = True
+
+
+def make_class(n):
+    attrs = dict(("attr_%05d" % i, i) for i in range(n))
+    return type("Big", (object,), attrs)
+
+
+def make_globals(n):
+    namespace = dict(("name_%05d" % i, i) for i in range(n))
+    namespace.update(("func_%05d" % i, len) for i in range(n // 10))
+    return namespace
+
+
+@pytest.fixture(scope="module")
+def big_globals():
+    return make_globals(50000)
+
+
+@pytest.fixture(scope="module")
+def big_class():
+    return make_class(10000)
+
+
+@pytest.mark.parametrize("config", [PlainConfig, ColorConfig])
+def test_global_matches_50k(bench, big_globals, config):
+    compl = Completer(big_globals, config)
+    bench(lambda: compl.global_matches("name_001"))
+
+
+def test_global_matches_50k_unique(bench, big_globals):
+    compl = Completer(big_globals, ColorConfig)
+    bench(lambda: compl.global_matches("name_0012"))
+
+
+@pytest.mark.parametrize("text", ["n1", "nm0012", "fn9"])
+def test_global_matches_50k_fuzzy(bench, big_globals, text):
+    compl = Completer(big_globals, FuzzyConfig)
+    result = bench(lambda: compl.global_matches(text))
+    assert result["p50_us"] < FUZZY_TARGET_US, result
+
+
+@pytest.mark.parametrize("config", [PlainConfig, ColorConfig])
+def test_attr_matches_10k_attrs(bench, big_class, config):
+    compl = Completer({"obj": big_class()}, config)
+    bench(lambda: compl.attr_matches("obj.attr_0"))
+
+
+def test_attr_matches_10k_attrs_cold(bench, big_class):
+    compl = Completer({"obj": big_class()}, ColorConfig)
+
+    def setup():
+        # forget everything computed by the previous round
+        compl.attr_index = type(compl.attr_index)()
+        compl._attr_context = None
+        compl._resolver.reset()
+
+    bench(lambda: compl.attr_matches("obj.attr_0"), setup=setup)
+
+
+def test_attr_matches_slow_properties(bench):
+    def slow(self):
+        time.sleep(0.0005)
+        return 42
+
+    attrs = dict(("prop_%03d" % i, property(slow)) for i in range(100))
+    obj = type("Slow", (object,), attrs)()
+
+    class Config(ColorConfig):
+        completion_budget_ms = 5
+
+    compl = Completer({"obj": obj}, Config)
+
+    def setup():
+        compl._attr_context = None
+
+    bench(lambda: compl.attr_matches("obj.prop_0"), rounds=20, setup=setup)
+
+
+def test_attr_matches_deep_path(bench):
+    class Node(object):
+        pass
+
+    root = node = Node()
+    path = ["root"]
+    for i in range(30):
+        child = Node()
+        setattr(node, "child_%d" % i, child)
+        node = child
+        path.append("child_%d" % i)
+    node.leaf_a = node.leaf_b = 1
+    text = ".".join(path) + ".leaf_"
+    compl = Completer({"root": root}, ColorConfig)
+
+    def setup():
+        compl._resolver.reset()
+        compl._attr_context = None
+
+    bench(lambda: compl.attr_matches(text), setup=setup)
+
+
+@pytest.mark.parametrize("n", [100, 5000])
+def test_color_matches(bench, n):
+    compl = Completer({}, ColorConfig)
+    names = ["name_%05d" % i for i in range(n)]
+    values = [i if i % 3 else str(i) for i in range(n)]
+    bench(lambda: compl.color_matches(names, values))
+
+
+def test_commonprefix_50k(bench):
+    names = ["name_%05d" % i for i in range(50000)]
+    bench(lambda: commonprefix(names))
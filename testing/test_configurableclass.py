@@ -1,6 +1,7 @@
 import os
 
-from fancycompleter import ConfigurableClass
+import fancycompleter
+from fancycompleter import ConfigurableClass, compile_cached
 
 
 def test_config(tmphome, capsys, LineMatcher):
@@ -53,3 +54,59 @@ def test_config(tmphome, capsys, LineMatcher):
         '  File "*/test_config0/.mycfg", line 1, in <module>',
         "    raise Exception('my_execfile_exc')",
     ])
+
+
+def test_config_cached(tmphome, monkeypatch):
+    class DefaultCfg:
+        default = 42
+
+    class MyCfg(ConfigurableClass):
+        DefaultConfig = DefaultCfg
+        config_filename = ".mycfg"
+
+    cfgfile = tmphome.join(MyCfg.config_filename)
+    cfgfile.write("loaded = []\n"
+                  "class Config:\n"
+                  "    loaded.append(1)\n"
+                  "    loads = loaded\n")
+    cfg = MyCfg()
+    config = cfg.get_config(None)
+    assert config.loads == [1]
+    # the file is not executed again, but a new instance is returned
+    config2 = cfg.get_config(None)
+    assert config2.loads == [1]
+    assert config2 is not config
+    assert type(config2) is type(config)
+
+    # changing the file invalidates the cache
+    cfgfile.write("class Config:\n"
+                  "    loads = 'new'\n")
+    assert cfg.get_config(None).loads == 'new'
+
+
+def test_compile_cached(tmphome, monkeypatch):
+    src = tmphome.join("rc.py")
+    src.write("x = 42\n")
+    code = compile_cached(str(src))
+    cache_files = tmphome.join(".cache", "fancycompleter").listdir()
+    assert len(cache_files) == 1
+
+    # the code object is loaded from the cache
+    def compile(*args):
+        assert False, "should not be called"
+
+    monkeypatch.setattr(fancycompleter, "compile", compile, raising=False)
+    code2 = compile_cached(str(src))
+    assert code2 == code
+    assert code2.co_filename == str(src)
+    mydict = {}
+    exec(code2, mydict)
+    assert mydict["x"] == 42
+
+    # changing the source invalidates the cache
+    monkeypatch.delattr(fancycompleter, "compile")
+    src.write("x = 'changed'\n")
+    mydict = {}
+    exec(compile_cached(str(src)), mydict)
+    assert mydict["x"] == "changed"
+    assert len(tmphome.join(".cache", "fancycompleter").listdir()) == 1
@@ -1,7 +1,15 @@
+import os
+import rlcompleter
 import sys
+import types
 
-from fancycompleter import (Color, Completer, DefaultConfig, Installer,
-                            LazyVersion, commonprefix)
+import pytest
+
+from fancycompleter import (AttrIndex, Color, Completer, DefaultConfig,
+                            FuzzyIndex, Installer, LazyVersion, NameIndex,
+                            PathResolver, Prefetcher, commonprefix,
+                            format_stats, fuzzy_score, parse_path,
+                            static_lookup)
 
 
 class ConfigForTest(DefaultConfig):
@@ -116,13 +124,10 @@ def test_complete_global_colored_exception():
 
 
 def test_complete_global_exception(monkeypatch):
-    import rlcompleter
-
-    def rlcompleter_global_matches(self, text):
+    def global_names(self, text):
         return ['trigger_exception!', 'nameerror', 'valid']
 
-    monkeypatch.setattr(rlcompleter.Completer, 'global_matches',
-                        rlcompleter_global_matches)
+    monkeypatch.setattr(Completer, 'global_names', global_names)
 
     compl = Completer({'valid': 42}, ColorConfig)
     assert compl.global_matches("") == [
@@ -141,6 +146,27 @@ def test_color_for_obj(monkeypatch):
     assert compl.color_for_obj(1, "foo", "bar") == "\x1b[001;00m\x1b[00mfoo\x1b[00m"
 
 
+def test_color_for_obj_cache():
+    class MyError(ValueError):
+        pass
+
+    compl = Completer({}, ColorConfig)
+    assert compl.color_for_obj(0, 'x', MyError()) == (
+        '\x1b[000;00m\x1b[31;01mx\x1b[00m')
+    assert compl._color_cache[MyError] == Color.red
+    assert compl.color_for_obj(1, 'x', 42) == (
+        '\x1b[001;00m\x1b[33;01mx\x1b[00m')
+
+    # changing the config invalidates the cache
+    compl.config.color_by_baseclass = [((ValueError,), 'purple')]
+    assert compl.color_for_obj(2, 'x', MyError()) == (
+        '\x1b[002;00m\x1b[35mx\x1b[00m')
+    compl.config.color_by_type = dict(compl.config.color_by_type)
+    compl.config.color_by_type[MyError] = Color.green
+    assert compl.color_for_obj(3, 'x', MyError()) == (
+        '\x1b[003;00m\x1b[32;01mx\x1b[00m')
+
+
 def test_complete_with_indexer():
     compl = Completer({'lst': [None, 2, 3]}, ConfigForTest)
     assert compl.attr_matches('lst[0].') == ['lst[0].__']
@@ -204,6 +230,1324 @@ def test_unicode_in___dir__():
     assert type(matches[0]) is str
 
 
+def test_attr_index():
+    class C(object):
+        aaa = 1
+        abb = 2
+
+    index = AttrIndex()
+    obj = C()
+    assert index.matches(obj, 'a') == ['aaa', 'abb']
+    assert index.matches(obj, 'ab') == ['abb']
+    assert index.matches(obj, 'x') == []
+
+    # names of the instance are merged in
+    obj.acc = 3
+    assert index.matches(obj, 'a') == ['aaa', 'abb', 'acc']
+    assert index.matches(C(), 'a') == ['aaa', 'abb']
+
+    # the entry is invalidated when the class (or a base) changes
+    C.abc = 4
+    assert index.matches(C(), 'a') == ['aaa', 'abb', 'abc']
+    del C.aaa
+    assert index.matches(C(), 'a') == ['abb', 'abc']
+    assert index.matches(C, 'a') == ['abb', 'abc']
+
+    # a rename keeps the size of the __dict__ unchanged
+    del C.abb
+    C.abd = 5
+    assert index.matches(C(), 'a') == ['abc', 'abd']
+    assert index.matches(C, 'a') == ['abc', 'abd']
+    del obj.acc
+    obj.ace = 6
+    assert index.matches(obj, 'a') == ['abc', 'abd', 'ace']
+
+    # the same for modules
+    mod = types.ModuleType('mod')
+    mod.foo_a = 1
+    assert index.matches(mod, 'foo') == ['foo_a']
+    del mod.foo_a
+    mod.foo_b = 2
+    assert index.matches(mod, 'foo') == ['foo_b']
+
+
+def test_attr_index_same_words_as_dir():
+    import os
+
+    class Foo(object):
+        def __dir__(self):
+            return ['hello', 'world']
+
+    index = AttrIndex()
+    for obj in (None, 42, 'x', os, str, Foo(), Foo, [], ValueError()):
+        expected = set(dir(obj))
+        expected.discard('__builtins__')
+        expected.add('__class__')
+        expected.update(rlcompleter.get_class_members(obj.__class__))
+        assert index.matches(obj) == sorted(expected)
+        assert index.matches(obj) == sorted(expected)
+
+
+def test_static_lookup():
+    calls = []
+
+    class C(object):
+        attr = 42
+        __slots__ = ('slot', '__dict__')
+
+        @property
+        def prop(self):
+            calls.append('prop')
+            return 1
+
+        def method(self):
+            pass
+
+        @classmethod
+        def cmeth(cls):
+            pass
+
+        def __getattr__(self, name):
+            calls.append(name)
+            if name == 'dynamic':
+                return 'dyn'
+            raise AttributeError(name)
+
+    obj = C()
+    obj.slot = 'slot'
+    obj.inst = 'inst'
+    assert static_lookup(obj, 'attr') == 42
+    assert static_lookup(obj, 'inst') == 'inst'
+    assert static_lookup(obj, 'slot') == 'slot'
+    assert isinstance(static_lookup(obj, 'prop'), property)
+    assert isinstance(static_lookup(obj, 'method'), types.MethodType)
+    assert isinstance(static_lookup(obj, 'cmeth'), types.MethodType)
+    assert type(static_lookup(C, 'method')) is type(C.method)
+    assert isinstance(static_lookup(C, 'prop'), property)
+    assert static_lookup(C, 'mro')() == C.mro()
+    assert calls == []
+    # __getattr__ is called only when the static lookup fails
+    assert static_lookup(obj, 'dynamic') == 'dyn'
+    assert calls == ['dynamic']
+
+
+def test_complete_static_attr_lookup():
+    class Config(ColorConfig):
+        static_attr_lookup = True
+
+    class C(object):
+        @property
+        def foo_prop(self):
+            raise AssertionError('should not be called')
+
+        def foo_method(self):
+            pass
+
+    compl = Completer({'a': C()}, Config)
+    assert compl.attr_matches('a.foo') == ['a.foo_']
+    assert compl.attr_matches('a.foo_') == [
+        '\x1b[000;00m\x1b[36;01mfoo_method\x1b[00m',
+        '\x1b[001;00m\x1b[00mfoo_prop\x1b[00m',
+        ' ',
+    ]
+
+
+def test_completion_budget():
+    calls = []
+
+    class C(object):
+        @property
+        def foo_a(self):
+            calls.append('foo_a')
+            return 1
+
+        @property
+        def foo_b(self):
+            calls.append('foo_b')
+            return 2
+
+    class Config(ColorConfig):
+        completion_budget_ms = 0
+
+    compl = Completer({'a': C(), 'foo_x': 1, 'foo_y': 2}, Config)
+    assert compl.attr_matches('a.foo_') == [
+        '\x1b[000;00mfoo_a',
+        '\x1b[001;00mfoo_b',
+        ' ',
+    ]
+    assert calls == []
+    assert compl.global_matches('foo_') == [
+        '\x1b[000;00mfoo_x',
+        '\x1b[001;00mfoo_y',
+        ' ',
+    ]
+
+    Config.completion_budget_ms = 10000
+    compl = Completer({'a': C()}, Config)
+    assert compl.attr_matches('a.foo_') == [
+        '\x1b[000;00m\x1b[33;01mfoo_a\x1b[00m',
+        '\x1b[001;00m\x1b[33;01mfoo_b\x1b[00m',
+        ' ',
+    ]
+    assert calls == ['foo_a', 'foo_b']
+
+
+def test_global_names_same_as_rlcompleter():
+    namespace = {'foo': 1, 'foobar': 2, 'print_me': 3, 'try_': 4, 'len': 5}
+    compl = Completer(namespace, ConfigForTest)
+    rlcompl = rlcompleter.Completer(namespace)
+    rlcompl._callable_postfix = compl._callable_postfix
+    for text in ('', 'f', 'foo', 'pr', 'tr', 'le', '_', '__', 'x'):
+        expected = rlcompleter.Completer.global_matches(rlcompl, text)
+        assert sorted(compl.global_names(text)) == sorted(expected)
+
+
+def test_name_index():
+    namespace = {'aaa': 1, 'abb': 2, 'bbb': 3, 42: 'not a name'}
+    index = NameIndex()
+    assert index.matches(namespace, 'a') == ['aaa', 'abb']
+    assert index.matches(namespace) == ['aaa', 'abb', 'bbb']
+    namespace['acc'] = 4
+    assert index.matches(namespace, 'a') == ['aaa', 'abb', 'acc']
+    # same size, different names
+    del namespace['aaa']
+    namespace['ccc'] = 5
+    assert index.matches(namespace, 'a') == ['abb', 'acc']
+    assert index.matches(namespace, 'c') == ['ccc']
+
+
+def test_narrow_previous_completion():
+    calls = []
+
+    class Proxy(object):
+        def __dir__(self):
+            calls.append('dir')
+            return ['get_a', 'get_b', 'get_bb', 'set_a']
+
+        def __getattr__(self, name):
+            calls.append(name)
+            return 42
+
+    proxy = Proxy()
+    compl = Completer({'p': proxy}, ColorConfig)
+    compl.config.readline = readline = LineReadline()
+    assert len(complete_line(compl, 'p.g')) == 1
+    assert calls == ['dir']
+    assert len(complete_line(compl, 'p.get_')) == 4
+    assert calls == ['dir', 'get_a', 'get_b', 'get_bb']
+    del calls[:]
+    assert len(complete_line(compl, 'p.get_b')) == 3
+    assert complete_line(compl, 'p.get_bb') == ['p.get_bb']
+    assert calls == []
+
+    # a new line, or one which does not extend the previous one, start
+    # from scratch
+    readline.add_history('p = Proxy()')
+    compl.namespace['p'] = Proxy()
+    assert complete_line(compl, 'p.get_bb') == ['p.get_bb']
+    assert complete_line(compl, 'p.s') == ['p.set_a']
+    assert calls == ['dir', 'dir']
+    # and so do the direct calls
+    assert compl.attr_matches('p.set') == ['p.set_a']
+    assert calls == ['dir', 'dir', 'dir']
+
+
+def test_narrow_previous_completion_new_prompt():
+    class Proxy(object):
+        names = ['get_a', 'get_b']
+
+        def __dir__(self):
+            return self.names
+
+        def __getattr__(self, name):
+            return 42
+
+    proxy = Proxy()
+    compl = Completer({'p': proxy}, ConfigForTest)
+    compl.config.readline = readline = LineReadline()
+    assert complete_line(compl, 'p.get_') == ['get_a', 'get_b', ' ']
+    # the names of a custom __dir__ change at the next prompt, even if the
+    # new line extends the previous one
+    readline.add_history('p.add("get_bc")')
+    proxy.names = ['get_a', 'get_b', 'get_bc']
+    assert complete_line(compl, 'p.get_b') == ['get_b', 'get_bc', ' ']
+
+
+def test_narrow_previous_completion_class_changed():
+    class C(object):
+        foo_a = 1
+
+    compl = Completer({'c': C()}, ConfigForTest)
+    assert compl.attr_matches('c.foo') == ['c.foo_a']
+    C.foo_b = 2
+    assert compl.attr_matches('c.foo_') == ['foo_a', 'foo_b', ' ']
+
+
+def test_parse_path():
+    assert parse_path('a') == (('name', 'a'),)
+    assert parse_path("a.b[0].c['x']") == (
+        ('name', 'a'), ('attr', 'b'), ('item', 0), ('attr', 'c'),
+        ('item', 'x'))
+    assert parse_path('a[-1][i]') == (
+        ('name', 'a'), ('item', -1), ('item_name', 'i'))
+    assert parse_path("'abc'") == (('const', 'abc'),)
+    assert parse_path('a[1:2]')[1] == ('item', slice(1, 2, None))
+    assert parse_path('a.b()') is None
+    assert parse_path('a[b.c]') is None
+    assert parse_path('a + b') is None
+    assert parse_path('a[') is None
+
+
+def test_path_resolver_memoizes():
+    calls = []
+
+    class C(object):
+        @property
+        def child(self):
+            calls.append('child')
+            return C()
+
+    namespace = {'root': C(), 'key': 1}
+    resolver = PathResolver()
+    steps = parse_path('root.child.child')
+    obj = resolver.resolve(steps, namespace)
+    assert calls == ['child', 'child']
+    assert resolver.resolve(steps, namespace) is obj
+    assert resolver.resolve(parse_path('root.child'), namespace) is not obj
+    assert calls == ['child', 'child']
+    resolver.reset()
+    assert resolver.resolve(steps, namespace) is not obj
+    assert calls == ['child', 'child', 'child', 'child']
+
+    # rebinding the root name invalidates the memo
+    namespace['root'] = C()
+    resolver.resolve(steps, namespace)
+    assert len(calls) == 6
+
+    namespace['lst'] = [10, 20, 30]
+    assert resolver.resolve(parse_path('lst[key]'), namespace) == 20
+    assert resolver.resolve(parse_path('lst[-1]'), namespace) == 30
+    assert resolver.resolve(parse_path('len'), namespace) is len
+    namespace['key'] = 2
+    assert resolver.resolve(parse_path('lst[key]'), namespace) == 30
+
+
+def test_rebound_attribute_between_completions():
+    class X(object):
+        xattr = 1
+
+    class Y(object):
+        yattr = 1
+
+    class A(object):
+        pass
+
+    a = A()
+    a.b = X()
+    compl = Completer({'a': a}, ConfigForTest)
+    assert compl.attr_matches('a.b.y') == []
+    a.b = Y()  # e.g. code run at the prompt
+    assert compl.attr_matches('a.b.y') == ['a.b.yattr']
+
+
+class LineReadline(object):
+    """A readline whose line buffer and history are set by the test."""
+
+    def __init__(self):
+        self.line = ''
+        self.history = []
+
+    def add_history(self, entry):
+        self.history.append(entry)
+
+    def get_current_history_length(self):
+        return len(self.history)
+
+    def get_line_buffer(self):
+        return self.line
+
+    def get_endidx(self):
+        return len(self.line)
+
+
+def complete_line(compl, line):
+    """Complete the last word of 'line' like readline does."""
+    compl.config.readline.line = line
+    text = line.split()[-1] if line.strip() else ''
+    matches = []
+    while True:
+        match = compl.complete(text, len(matches))
+        if match is None:
+            return matches
+        matches.append(match)
+
+
+def test_resolved_objects_per_input_line():
+    class X(object):
+        xattr = 1
+
+    class Y(object):
+        yattr = 1
+
+    class A(object):
+        pass
+
+    a = A()
+    a.b = X()
+    compl = Completer({'a': a}, ConfigForTest)
+    compl.config.readline = readline = LineReadline()
+    assert complete_line(compl, 'a.b.x') == ['a.b.xattr']
+    hits = compl._resolver.hits
+    # the same line, the cursor further on: a.b is not looked up again
+    assert complete_line(compl, 'a.b.xa') == ['a.b.xattr']
+    assert compl._resolver.hits > hits
+
+    # the next line extends the previous one, but a.b changed in between
+    readline.add_history('a.b = Y()')
+    a.b = Y()
+    assert complete_line(compl, 'a.b.xat') == []
+    assert complete_line(compl, 'a.b.ya') == ['a.b.yattr']
+
+
+def test_complete_attribute_does_not_eval():
+    compl = Completer({'a': 'abc'}, ConfigForTest)
+    assert compl.attr_matches('a.__class__.__na') == ['a.__class__.__name__']
+    assert compl.attr_matches('"x".upp') == ['"x".upper']
+    assert compl.attr_matches('[a for a in x].app') == []
+    assert compl.attr_matches('a if a else a.upp') == []
+
+
+def test_prefetcher():
+    import os
+
+    class C(object):
+        attr = 1
+
+    class Foo(object):
+        def __dir__(self):
+            raise AssertionError('should not be called')
+
+    calls = []
+
+    class Lazy(object):
+        attr = 1
+
+        @property
+        def __class__(self):
+            calls.append('__class__')
+            return Lazy
+
+        @property
+        def __dict__(self):
+            calls.append('__dict__')
+            return {}
+
+        def __getattr__(self, name):
+            calls.append(name)
+            raise AttributeError(name)
+
+    class Config(ColorConfig):
+        prefetch_cpu_share = 1
+
+    compl = Completer({'os': os, 'c': C(), 'foo': Foo(), 'lazy': Lazy()},
+                      Config)
+    compl.attr_index = AttrIndex()
+    prefetcher = Prefetcher(compl)
+    prefetcher.notify('c')
+    objs = prefetcher.candidates(compl.namespace)
+    assert objs[0] is compl.namespace['c']
+    assert objs[1] is os
+    assert prefetcher.warm_up()
+    cached = set(compl.attr_index._cache.keys())
+    cached.update(compl.attr_index._modules)
+    assert C in cached
+    assert os in cached
+    assert os.path in cached
+    assert Foo not in cached
+    assert Lazy in cached
+    # no code of the instances runs in the background
+    assert calls == []
+
+
+def test_prefetcher_thread():
+    class Config(ConfigForTest):
+        prefetch = True
+
+    compl = Completer({'c': 42}, Config)
+    prefetcher = compl.prefetcher
+    assert prefetcher._thread.is_alive()
+    assert compl.attr_matches('c.re') == ['c.real']
+    prefetcher.stop(timeout=10)
+    assert not prefetcher._thread.is_alive()
+
+
+def test_stats():
+    class Config(ColorConfig):
+        collect_stats = True
+
+    class C(object):
+        foo = 0
+        foo_a = 1
+        foo_b = 2
+
+    assert Completer({}, ColorConfig).stats() is None
+
+    compl = Completer({'c': C(), 'foo_x': 1, 'foo_y': 2}, Config)
+    compl.config.readline = LineReadline()
+    complete_line(compl, 'c.foo')
+    complete_line(compl, 'c.foo_')
+    compl.global_matches('foo_')
+    stats = compl.stats()
+    assert set(stats['phases']) == set(['eval', 'dir', 'filter', 'values',
+                                        'color'])
+    assert stats['phases']['eval']['count'] == 2
+    assert stats['phases']['color']['count'] == 3
+    counters = stats['counters']
+    assert counters['completions'] == 3
+    assert counters['attr_completions'] == 2
+    assert counters['global_completions'] == 1
+    assert counters['matches'] == 7
+    assert counters['narrowed'] == 1
+    assert counters['values_cached'] == 2
+    assert counters['color_cache_misses'] == 1
+    assert 'attr_index_hits' in counters
+    assert 'fancycompleter stats:' in format_stats(stats)
+
+
+def test_stats_dumped_at_exit(testdir, monkeypatch):
+    monkeypatch.setenv('FANCYCOMPLETER_STATS', '1')
+    monkeypatch.setenv('PYTHONPATH', os.path.dirname(
+        os.path.dirname(os.path.abspath(__file__))))
+    script = testdir.makepyfile(
+        '''
+        import fancycompleter
+
+        class Config(fancycompleter.DefaultConfig):
+            use_colors = False
+
+        compl = fancycompleter.Completer({'foo': 1}, Config)
+        compl.global_matches('fo')
+        compl = fancycompleter.Completer({'foo': 1}, Config)
+        compl.global_matches('fo')
+        fancycompleter.Completer({'foo': 1}, Config).global_matches('fo')
+        # the completers are not kept alive until exit
+        import gc, weakref
+        ref = weakref.ref(compl)
+        del compl
+        gc.collect()
+        assert ref() is None
+        '''
+    )
+    result = testdir.runpython(script)
+    result.stderr.fnmatch_lines([
+        'fancycompleter stats:',
+        '  dir *',
+    ])
+    result.stderr.fnmatch_lines(['  completions *3'])
+    assert result.stderr.str().count('fancycompleter stats:') == 1
+
+
+# import cost of fancycompleter, on top of the one of rlcompleter
+IMPORT_BUDGET_US = 15000
+
+
+def _import_times(tmpdir):
+    import subprocess
+
+    env = dict(os.environ)
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+    env['PYTHONPATH'] = os.path.dirname(os.path.dirname(
+        os.path.abspath(__file__)))
+    cmd = [sys.executable, '-X', 'importtime',
+           '-X', 'pycache_prefix=%s' % tmpdir, '-c', 'import fancycompleter']
+    p = subprocess.Popen(cmd, env=env, stderr=subprocess.PIPE,
+                         universal_newlines=True)
+    err = p.communicate()[1]
+    assert p.returncode == 0, err
+    times = {}
+    for line in err.splitlines():
+        if line.startswith('import time:') and '|' in line:
+            _, cumulative, name = line.split('|')
+            if cumulative.strip().isdigit():
+                times[name.strip()] = int(cumulative)
+    return times
+
+
+@pytest.mark.skipif(sys.version_info < (3, 8),
+                    reason='needs -X importtime and pycache_prefix')
+def test_import_cost(tmpdir):
+    _import_times(tmpdir)  # write the bytecode
+    costs = []
+    for i in range(3):
+        times = _import_times(tmpdir)
+        costs.append(times['fancycompleter'] - times.get('rlcompleter', 0))
+        # no packaging machinery nor backend at import time
+        for name in ('pkg_resources', 'importlib.metadata', 'pyrepl',
+                     'pyreadline'):
+            assert name not in times
+    assert min(costs) < IMPORT_BUDGET_US, costs
+
+
+def test_max_matches():
+    calls = []
+
+    class C(object):
+        def __getattr__(self, name):
+            calls.append(name)
+            return 42
+
+        def __dir__(self):
+            return ['foo_%d' % i for i in range(10)] + ['other']
+
+    class Config(ConfigForTest):
+        max_matches = 3
+
+    namespace = dict(('foo_%d' % i, i) for i in range(10))
+    namespace['c'] = C()
+    compl = Completer(namespace, Config)
+    assert compl.attr_matches('c.foo_') == [
+        'foo_0', 'foo_1', 'foo_2', '... 7 more', ' ']
+    assert compl.global_matches('foo_') == [
+        'foo_0', 'foo_1', 'foo_2', '... 7 more']
+    # narrowing still gives exact results
+    assert compl.attr_matches('c.foo_') == [
+        'foo_0', 'foo_1', 'foo_2', '... 7 more', ' ']
+    assert compl.attr_matches('c.foo_7') == ['c.foo_7']
+    assert compl.attr_matches('c.f') == ['c.foo_']
+
+    class ColorConfig(Config):
+        use_colors = True
+
+    compl = Completer(namespace, ColorConfig)
+    assert compl.attr_matches('c.foo_') == [
+        '\x1b[000;00m\x1b[33;01mfoo_0\x1b[00m',
+        '\x1b[001;00m\x1b[33;01mfoo_1\x1b[00m',
+        '\x1b[002;00m\x1b[33;01mfoo_2\x1b[00m',
+        '\x1b[003;00m... 7 more',
+        ' ',
+    ]
+    assert calls == ['foo_0', 'foo_1', 'foo_2']
+    assert compl.global_matches('foo_') == [
+        '\x1b[000;00m\x1b[33;01mfoo_0\x1b[00m',
+        '\x1b[001;00m\x1b[33;01mfoo_1\x1b[00m',
+        '\x1b[002;00m\x1b[33;01mfoo_2\x1b[00m',
+        '\x1b[003;00m... 7 more',
+        ' ',
+    ]
+
+
+def test_completion_timeout():
+    import threading
+
+    release = threading.Event()
+
+    class Proxy(object):
+        names = ['remote_a', 'remote_b']
+
+        def __dir__(self):
+            release.wait(10)
+            return self.names
+
+    class Config(ConfigForTest):
+        completion_timeout_ms = 50
+
+    proxy = Proxy()
+    compl = Completer({'p': proxy, 'foo': 1}, Config)
+    assert compl.complete('p.remote_', 0) is None
+    job, = compl._worker._jobs.values()
+    release.set()
+    assert job.done.wait(10)
+    # the late result is used by the next completion only
+    assert compl.complete('p.remote_', 0) == 'remote_a'
+    assert compl.complete('p.remote_', 1) == 'remote_b'
+    assert compl.complete('p.remote_', 2) == ' '
+    assert compl.complete('p.remote_', 3) is None
+    proxy.names = ['remote_a', 'remote_c']
+    assert compl.complete('p.remote_', 0) == 'remote_a'
+    assert compl.complete('p.remote_', 1) == 'remote_c'
+    assert compl.complete('fo', 0) == 'foo'
+
+    # and it is discarded by the completion of another text
+    release.clear()
+    assert compl.complete('p.remote_', 0) is None
+    job, = compl._worker._jobs.values()
+    release.set()
+    assert job.done.wait(10)
+    assert compl.complete('fo', 0) == 'foo'
+    assert compl._worker._late is None
+
+
+def test_completion_timeout_partial():
+    import threading
+
+    release = threading.Event()
+
+    class Proxy(object):
+        def __dir__(self):
+            return ['remote_a', 'remote_b']
+
+        def __getattr__(self, name):
+            release.wait(10)
+            return 42
+
+    class Config(ColorConfig):
+        completion_timeout_ms = 50
+
+    compl = Completer({'p': Proxy()}, Config)
+    # the names are known, but not their colors
+    assert compl.complete('p.remote_', 0) == 'remote_a'
+    assert compl.complete('p.remote_', 1) == 'remote_b'
+    release.set()
+
+
+def test_fuzzy_score():
+    assert fuzzy_score('gvc', 'get_value_counts') is not None
+    assert fuzzy_score('gvc', 'describe') is None
+    # prefix matches first, then matches at the start of the parts
+    assert fuzzy_score('get', 'getter') > fuzzy_score('get', 'get_value')
+    assert fuzzy_score('get', 'get_value') > fuzzy_score('get', 'target')
+    assert fuzzy_score('gv', 'get_value') > fuzzy_score('gv', 'gravy')
+    assert fuzzy_score('gv', 'getValue') > fuzzy_score('gv', 'gravy')
+
+
+def test_fuzzy_matching():
+    class Frame(object):
+        def describe(self):
+            pass
+
+        def get_value_counts(self):
+            pass
+
+        def groupby(self):
+            pass
+
+        def _dispatch(self):
+            pass
+
+    class Config(ConfigForTest):
+        fuzzy_matching = True
+
+    compl = Completer({'df': Frame(), 'my_value': 1}, Config)
+    assert compl.attr_matches('df.ds') == ['df.describe']
+    assert compl.attr_matches('df.gvc') == ['df.get_value_counts']
+    # ranked, and readline must not replace 'gu' with a common prefix
+    assert compl.attr_matches('df.gu') == ['groupby', 'get_value_counts', ' ']
+    # prefix matches behave as usual
+    assert compl.attr_matches('df.gr') == ['df.groupby']
+    assert compl.attr_matches('df.g') == ['get_value_counts', 'groupby', ' ']
+    assert compl.attr_matches('df._d') == ['df._dispatch']
+    assert compl.attr_matches('df.xyz') == []
+    assert compl.global_matches('mvl') == ['my_value']
+    # a single character is completed only by prefix
+    assert compl.attr_matches('df.v') == []
+
+    compl = Completer({'df': Frame()}, ConfigForTest)
+    assert compl.attr_matches('df.ds') == []
+
+
+def test_fuzzy_index():
+    names = sorted(['get_value_counts', 'GroupBy', 'describe', 'gravy',
+                    'getValue', '_gv', 'gv_x'])
+    index = FuzzyIndex(names)
+    assert index.candidates('GV') == ['_gv', 'gv_x', 'gravy', 'getValue',
+                                      'get_value_counts']
+    assert index.candidates('xyz') == []
+    assert sorted(index.scored('gv')) == sorted(
+        (-fuzzy_score('gv', name), name)
+        for name in ['get_value_counts', 'gravy', 'getValue', 'gv_x'])
+    # too many matches: the names starting with the query come first, then
+    # the shortest ones
+    index.max_ranked = 2
+    assert sorted(name for _, name in index.scored('gv')) == ['gravy', 'gv_x']
+    assert sorted(name for _, name in index.scored('ge')) == [
+        'getValue', 'get_value_counts']
+
+
+def test_key_matches():
+    cfg = {'db': {'host': 1, 'hostname': 2, 'port': 3}, 'debug': True,
+           42: None, ('not', 'a literal'): None}
+    compl = Completer({'cfg': cfg}, ConfigForTest)
+    assert compl.key_matches("cfg['d", 'd') == ['db', 'debug', ' ']
+    assert compl.key_matches("cfg['db']['p", 'p') == ["port']"]
+    assert compl.key_matches("cfg['db']['h", 'h') == ['host']
+    assert compl.key_matches('x = cfg["deb', 'deb') == ['debug"]']
+    assert compl.key_matches("cfg['db'][", '][') == ["]['"]
+    assert compl.key_matches('cfg[', 'cfg[') == ["'db'", "'debug'", '42',
+                                                 ' ']
+    assert compl.key_matches('cfg[4', 'cfg[4') == ['cfg[42]']
+    assert compl.key_matches("cfg['x", 'x') == []
+    # not a subscript of something with keys
+    assert compl.key_matches('cfg[i', 'cfg[i') is None
+    assert compl.key_matches("len['", '') is None
+    assert compl.key_matches("cfg.get('", '') is None
+
+
+def test_key_matches_escaped():
+    d = {"it's": 1, 'say "hi"': 2, 'a\\b': 3, 'two\nlines': 4}
+    compl = Completer({'d': d}, ConfigForTest)
+    assert compl.key_matches("d['it", 'it') == ["it\\'s']"]
+    assert compl.key_matches('d["it', 'it') == ['''it's"]''']
+    assert compl.key_matches('d["say', 'say') == ['say \\"hi\\""]']
+    assert compl.key_matches("d['a", 'a') == ["a\\\\b']"]
+    assert compl.key_matches("d['two", 'two') == []
+
+
+def test_key_index_per_input_line():
+    import gc
+    import weakref
+
+    class Dict(dict):
+        pass
+
+    compl = Completer({'d': Dict(key=1)}, ConfigForTest)
+    compl.config.readline = readline = LineReadline()
+    assert complete_line(compl, "d['") == ["d['key']"]
+    ref = weakref.ref(compl.namespace['d'])
+    del compl.namespace['d']
+    readline.add_history("d['key']")
+    complete_line(compl, 'x')
+    gc.collect()
+    assert ref() is None
+
+
+def test_key_matches_protocol():
+    class Store(object):
+        def _ipython_key_completions_(self):
+            return ['/group/a', '/group/b']
+
+        def __getitem__(self, key):
+            raise KeyError(key)
+
+    compl = Completer({'store': Store()}, ConfigForTest)
+    assert compl.key_matches("store['", '') == ['/group/']
+    assert compl.key_matches("store['/group/b", 'b') == ["b']"]
+
+
+def test_key_index():
+    from fancycompleter import KeyIndex
+    index = KeyIndex()
+    d = dict.fromkeys(['b', 'a', 'c'])
+    assert index.strings(d, '', 10) == ['a', 'b', 'c']
+    d['ab'] = None
+    assert index.strings(d, 'a', 10) == ['a', 'ab']
+    assert len(index.strings(dict.fromkeys(range(100), 0), '', 10)) == 0
+    assert len(index.reprs(dict.fromkeys(range(100), 0), '', 10)) == 10
+    assert index.strings(object(), '', 10) is None
+
+
+def test_complete_keys(monkeypatch):
+    compl = Completer({'cfg': {'name': 1}}, ConfigForTest)
+    monkeypatch.setattr(compl, '_line_before_cursor', lambda: "cfg['")
+    assert compl.complete('', 0) == "name']"
+    assert compl.complete('', 1) is None
+    monkeypatch.setattr(compl, '_line_before_cursor', lambda: 'cf')
+    assert compl.complete('cf', 0) == 'cfg'
+
+
+class FakeReadline(object):
+    def __init__(self):
+        self.history = []
+
+    def add_history(self, entry):
+        self.history.append(entry)
+
+    def get_current_history_length(self):
+        return len(self.history)
+
+    def get_history_item(self, i):
+        return self.history[i-1]
+
+
+def test_history_file(tmpdir):
+    from fancycompleter import HistoryFile, read_history_tail
+    filename = str(tmpdir.join('history'))
+    readline = FakeReadline()
+    history = HistoryFile(readline, filename, 3, using_pyrepl=True)
+    history.load()
+    readline.add_history('a = 1')
+    readline.add_history('def f():\n    pass')
+    history.save()
+    history.save()  # nothing new
+    assert read_history_tail(filename, 10)[0] == ['a = 1',
+                                                  'def f():\n    pass']
+
+    # another session appends, while the first one is still running
+    other = HistoryFile(FakeReadline(), filename, 3, using_pyrepl=True)
+    other.load()
+    assert other.readline.history == ['a = 1', 'def f():\n    pass']
+    other.readline.add_history('b = 2')
+    other.save()
+    readline.add_history('c = 3')
+    history.save()
+    entries, size = read_history_tail(filename, 3)
+    assert entries == ['def f():\n    pass', 'b = 2', 'c = 3']
+    assert size == len(b'def f():\r\n    pass\nb = 2\nc = 3\n')
+
+    # compacted once it gets twice as big as the loaded tail
+    history = HistoryFile(FakeReadline(), filename, 3, using_pyrepl=True)
+    history.load()
+    for i in range(10):
+        history.readline.add_history('x = %d' % i)
+    history.save()
+    with open(filename) as f:
+        assert f.read() == 'x = 7\nx = 8\nx = 9\n'
+
+
+def test_usage_index(tmpdir):
+    from fancycompleter import UsageIndex
+    filename = str(tmpdir.join('usage.json'))
+    index = UsageIndex(filename)
+    assert index.rank('os', ['path', 'sep']) is None
+    index.record('os', 'sep')
+    assert index.rank('os', ['path', 'sep']) == [1, 0]
+    assert index.rank('sys', ['path', 'sep']) is None
+
+    # the counts of parallel sessions are merged
+    other = UsageIndex(filename)
+    other.record('os', 'path')
+    other.record('os', 'path')
+    other.save()
+    index.save()
+    index = UsageIndex(filename)
+    assert index.rank('os', ['path', 'sep', 'name']) == [0, 1, 2]
+
+    index.max_names = 2
+    index.record('os', 'name')
+    index.record('os', 'name')
+    index.save()
+    assert sorted(UsageIndex(filename)._load()['os']) == ['name', 'path']
+
+
+def test_rank_by_usage(monkeypatch):
+    import fancycompleter
+    from fancycompleter import UsageIndex
+
+    class Config(ColorConfig):
+        rank_by_usage = True
+
+    class A(object):
+        aaa = abc = bbb = eee = 1
+
+    monkeypatch.setattr(fancycompleter, '_usage_index', UsageIndex(None))
+    obj = A()
+    compl = Completer({'a': obj, 'aaa': 1, 'abc': 2}, Config)
+    assert compl.attr_matches('a.b') == ['a.bbb']
+    assert compl.attr_matches('a.') == [
+        '\x1b[000;00m\x1b[33;01mbbb\x1b[00m',
+        '\x1b[001;00m\x1b[33;01maaa\x1b[00m',
+        '\x1b[002;00m\x1b[33;01mabc\x1b[00m',
+        '\x1b[003;00m\x1b[33;01meee\x1b[00m',
+        ' ']
+    compl.global_matches('abc')
+    assert compl.global_matches('a')[:2] == [
+        '\x1b[000;00m\x1b[33;01mabc\x1b[00m',
+        '\x1b[001;00m\x1b[00ma\x1b[00m']
+
+
+def test_module_index(tmpdir):
+    from fancycompleter import ModuleIndex, scan_modules
+    tmpdir.join('mod_a.py').write('')
+    tmpdir.join('pkg_b').ensure('__init__.py')
+    tmpdir.join('pkg_b', 'sub.py').write('')
+    tmpdir.join('not-a-module.py').write('')
+    tmpdir.join('data.txt').write('')
+    assert scan_modules(str(tmpdir)) == ['mod_a', 'pkg_b']
+
+    filename = str(tmpdir.join('modules.json'))
+    tmpdir.setmtime(1000000)
+    index = ModuleIndex(filename)
+    assert index.dir_modules(str(tmpdir)) == ['mod_a', 'pkg_b']
+    index.save()
+    # loaded from the file
+    tmpdir.join('mod_c.py').write('')
+    tmpdir.setmtime(1000000)
+    index = ModuleIndex(filename)
+    assert index.dir_modules(str(tmpdir)) == ['mod_a', 'pkg_b']
+    # rescanned when the mtime changes
+    tmpdir.setmtime(2000000)
+    assert index.dir_modules(str(tmpdir)) == ['mod_a', 'mod_c', 'pkg_b']
+
+
+def test_import_matches(tmpdir, monkeypatch):
+    import fancycompleter
+    from fancycompleter import ModuleIndex
+    monkeypatch.setattr(fancycompleter, '_module_index', ModuleIndex(None))
+    monkeypatch.syspath_prepend(str(tmpdir))
+    tmpdir.join('fctest_mod.py').write('')
+    tmpdir.join('fctest_pkg').ensure('__init__.py')
+    tmpdir.join('fctest_pkg', 'submodule.py').write('')
+    compl = Completer({}, ConfigForTest)
+    assert compl.import_matches('import fctest_', 'fctest_') == [
+        'fctest_mod', 'fctest_pkg']
+    assert compl.import_matches('import os, fctest_m', 'fctest_m') == [
+        'fctest_mod']
+    assert compl.import_matches('from fctest_pkg.s', 'fctest_pkg.s') == [
+        'fctest_pkg.submodule']
+    assert compl.import_matches('from fctest_pkg import s', 's') == [
+        'submodule']
+    assert 'path' in compl.import_matches('from os import pa', 'pa')
+    assert 'fctest_pkg' not in sys.modules
+    assert compl.import_matches('x = fctest_', 'fctest_') is None
+
+
+@pytest.mark.skipif(sys.version_info < (3,),
+                    reason='dicts are unordered: no signature to save')
+def test_module_cache(tmpdir, monkeypatch):
+    import fancycompleter
+    from fancycompleter import ModuleCache
+
+    class Config(ColorConfig):
+        module_cache = True
+
+    filename = str(tmpdir.join('module_attrs.json'))
+    mod = types.ModuleType('fctest_heavy')
+    mod.__version__ = '1.0'
+    mod.some_func = len
+    mod.some_int = 42
+    monkeypatch.setattr(fancycompleter, '_module_cache',
+                        ModuleCache(filename, 10))
+    compl = Completer({'mod': mod}, Config)
+    expected = [
+        '\x1b[000;00m\x1b[34;01msome_func\x1b[00m',
+        '\x1b[001;00m\x1b[33;01msome_int\x1b[00m',
+        ' ']
+    assert compl.attr_matches('mod.some_') == expected
+    fancycompleter._module_cache.save()
+
+    # a new session: the names and colors come from the file, even if
+    # they are wrong because the module changed without a new version
+    mod = types.ModuleType('fctest_heavy')
+    mod.__version__ = '1.0'
+    mod.some_func = 'not a function'
+    mod.some_int = 42
+    monkeypatch.setattr(fancycompleter, '_module_cache',
+                        ModuleCache(filename, 10))
+    monkeypatch.setattr(Completer, 'attr_index', AttrIndex())
+    compl = Completer({'mod': mod}, Config)
+    assert compl.attr_matches('mod.some_') == expected
+    assert compl.attr_index.misses == 0
+
+    # a module whose names were renamed is looked up again, even if its
+    # __dict__ has the same size
+    renamed = types.ModuleType('fctest_heavy')
+    renamed.__version__ = '1.0'
+    renamed.some_func = len
+    renamed.some_other = 42
+    assert Completer({'mod': renamed}, Config).attr_matches('mod.some_') == [
+        '\x1b[000;00m\x1b[34;01msome_func\x1b[00m',
+        '\x1b[001;00m\x1b[33;01msome_other\x1b[00m',
+        ' ']
+
+    # a new version is looked up again
+    mod.__version__ = '2.0'
+    assert compl.attr_matches('mod.some_')[0] == (
+        '\x1b[000;00m\x1b[32;01msome_func\x1b[00m')
+
+
+def test_module_cache_lru(tmpdir):
+    from fancycompleter import ModuleCache, read_json_cache
+    filename = str(tmpdir.join('module_attrs.json'))
+    cache = ModuleCache(filename, 2)
+    for i in range(3):
+        cache.get('mod%d' % i)['used'] = i
+    cache.save()
+    assert sorted(read_json_cache(filename)) == ['mod1', 'mod2']
+    # unreadable or invalid files are empty
+    tmpdir.join('module_attrs.json').write('[1]')
+    assert read_json_cache(filename) == {}
+    assert read_json_cache(str(tmpdir.join('missing.json'))) == {}
+    assert read_json_cache(None) == {}
+
+
+def test_attrs_hook():
+    calls = []
+
+    class Proxy(object):
+        def __fancycompleter_attrs__(self, prefix):
+            calls.append(prefix)
+            return [('remote_int', int), ('remote_func', 'blue'),
+                    'remote_other', ('_private', None)]
+
+        def __getattr__(self, name):
+            raise AssertionError('no round-trip expected: %s' % name)
+
+        def __dir__(self):
+            raise AssertionError('no round-trip expected')
+
+    compl = Completer({'p': Proxy()}, ColorConfig)
+    assert compl.attr_matches('p.remote_') == [
+        '\x1b[000;00m\x1b[34;01mremote_func\x1b[00m',
+        '\x1b[001;00m\x1b[33;01mremote_int\x1b[00m',
+        '\x1b[002;00mremote_other',
+        ' ']
+    assert compl.attr_matches('p.remote_i') == ['p.remote_int']
+    assert compl.attr_matches('p._') == ['p._private']
+    assert calls == ['remote_', 'remote_i', '_']
+
+    compl = Completer({'p': Proxy()}, ConfigForTest)
+    assert compl.attr_matches('p.') == ['p.remote_']
+    assert compl.attr_matches('p.remote_') == ['remote_func', 'remote_int',
+                                               'remote_other', ' ']
+
+
+def test_complete_batch():
+    from fancycompleter import Completion
+
+    class A(object):
+        def method(self):
+            pass
+        attr_int = 1
+        attr_str = 'x'
+        _private = None
+
+    compl = Completer({'a': A(), 'types': types, 'abc': 1}, ConfigForTest)
+    res = compl.complete_batch(['a.attr_', 'a.m', 'types.Mod', 'a.zz',
+                                'f(x).', 'ab', 'whi'], type_names=True)
+    assert res == [
+        [Completion('attr_int', 'value', '33;01', 'int'),
+         Completion('attr_str', 'value', '32;01', 'str')],
+        [Completion('method', 'function', '36;01',
+                    type(A().method).__name__)],
+        [Completion('ModuleType', 'class', '35;01', 'type')],
+        [],
+        [],
+        [Completion('abc', 'value', '33;01', 'int'),
+         Completion('abs', 'function', '34;01', 'builtin_function_or_method')],
+        [Completion('while', 'keyword', None, None)],
+    ]
+    assert [c.name for c in compl.complete_batch(['a.'])[0]] == [
+        'attr_int', 'attr_str', 'method']
+    assert compl.complete_batch(['a.attr_int'])[0][0].type_name is None
+
+
+@pytest.mark.skipif(sys.version_info < (3, 10), reason='no soft keywords')
+def test_soft_keywords(monkeypatch):
+    from fancycompleter import Completion
+    compl = Completer({'matrix': 1}, ConfigForTest)
+    assert compl.complete_batch(['mat', 'cas', '_'])[:2] == [
+        [Completion('match', 'keyword', None, None),
+         Completion('matrix', 'value', '33;01', None)],
+        [Completion('case', 'keyword', None, None)],
+    ]
+    assert compl.complete_batch(['_'])[0][0] == Completion('_', 'keyword',
+                                                           None, None)
+    # '_' is also a variable
+    compl.namespace['_'] = 42
+    assert compl.complete_batch(['_'])[0][0] == Completion('_', 'value',
+                                                           '33;01', None)
+
+    # the keywords are not looked up as names
+    import fancycompleter
+    lookups = []
+    lookup_name = fancycompleter.lookup_name
+
+    def fake_lookup_name(namespace, name):
+        lookups.append(name)
+        return lookup_name(namespace, name)
+
+    monkeypatch.setattr(fancycompleter, 'lookup_name', fake_lookup_name)
+    Completer({'matrix': 1}, ColorConfig).global_matches('mat')
+    assert lookups == ['matrix']
+
+
+def read_responses(sock, n):
+    from fancycompleter import decode_frames
+    buf = b''
+    responses = []
+    while len(responses) < n:
+        data = sock.recv(65536)
+        assert data
+        frames, buf = decode_frames(buf + data)
+        responses += frames
+    return responses
+
+
+def test_handle_connection():
+    import socket
+    from fancycompleter import encode_frame, handle_connection
+
+    compl = Completer({'foo': 1, 'foobar': 2, 'd': {'key': 1}},
+                      ConfigForTest)
+    client, server = socket.socketpair()
+    # pipelined, the last one split in two writes
+    last = encode_frame({'id': 4, 'method': 'nope'})
+    client.sendall(encode_frame([1]) +
+                   encode_frame({'id': 1, 'text': 'foo'}) +
+                   encode_frame({'id': 2, 'method': 'batch',
+                                 'texts': ['foob', 'd.ke'],
+                                 'type_names': True}) +
+                   encode_frame({'id': 3, 'text': '', 'line': "d['"}) +
+                   last[:3])
+    client.sendall(last[3:])
+    client.shutdown(socket.SHUT_WR)
+    handle_connection(compl, server)
+    assert read_responses(client, 5) == [
+        {'id': None, 'error': 'invalid request: not a JSON object'},
+        {'id': 1, 'matches': ['foo', 'foobar']},
+        {'id': 2, 'completions': [[['foobar', 'value', '33;01', 'int']],
+                                  [['keys', 'function', '34;01',
+                                    'builtin_function_or_method']]]},
+        {'id': 3, 'matches': ["key']"]},
+        {'id': 4, 'error': "unknown method: 'nope'"},
+    ]
+    assert client.recv(10) == b''
+
+
+def test_serve(tmpdir):
+    import socket
+    import threading
+    from fancycompleter import encode_frame
+    path = str(tmpdir.join('completer.sock'))
+    compl = Completer({'foobar': 1}, ConfigForTest)
+    compl.serve(path, block=False)
+    assert oct(os.stat(path).st_mode & 0o777) == oct(0o600)
+    for i in range(2):
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        client.connect(path)
+        client.sendall(encode_frame({'id': i, 'text': 'foob'}))
+        assert read_responses(client, 1) == [{'id': i,
+                                              'matches': ['foobar']}]
+        client.close()
+    # readline waits for the requests being served
+    assert compl.complete('foob', 0) == 'foobar'
+    compl._lock.acquire()
+    try:
+        thread = threading.Thread(target=compl.complete, args=('foob', 0))
+        thread.start()
+        thread.join(0.1)
+        assert thread.is_alive()
+    finally:
+        compl._lock.release()
+    thread.join()
+
+
+def test_serve_busy_with_timeout(tmpdir):
+    from fancycompleter import _timer
+
+    class Config(ConfigForTest):
+        completion_timeout_ms = 50
+
+    compl = Completer({'foobar': 1, 'd': {'key': 1}}, Config)
+    compl.config.readline = LineReadline()
+    compl.serve(str(tmpdir.join('completer.sock')), block=False)
+    # a request of the server which hangs does not block the prompt
+    compl._lock.acquire()
+    try:
+        for line in ('foob', "d['"):
+            start = _timer()
+            assert complete_line(compl, line) == []
+            assert _timer() - start < 5
+    finally:
+        compl._lock.release()
+    for job in list(compl._worker._jobs.values()):
+        assert job.done.wait(10)
+    assert complete_line(compl, 'foob') == ['foobar']
+
+
+def test_deferred_rendering():
+    from fancycompleter import _Match
+    compl = Completer({'a': 42, 'abc': 'x'}, ColorConfig)
+    records = compl._compute_matches('a')
+    assert type(records[0]) is _Match
+    assert (records[0].name, records[0].color, records[0].index) == (
+        'a', '33;01', 0)
+    rendered = compl.global_matches('a')
+    states = []
+    while True:
+        match = compl.complete('a', len(states))
+        if match is None:
+            break
+        states.append(match)
+    assert states == rendered
+    assert rendered[:2] == ['\x1b[000;00m\x1b[33;01ma\x1b[00m',
+                            '\x1b[001;00m\x1b[32;01mabc\x1b[00m']
+
+
+def test_overridden_matches_are_used():
+    class MyCompleter(Completer):
+        def attr_matches(self, text):
+            return ['attr:' + text]
+
+        def global_matches(self, text):
+            return ['global:' + text]
+
+    compl = MyCompleter({'a': 42}, ConfigForTest)
+    assert compl.complete('a.b', 0) == 'attr:a.b'
+    assert compl.complete('a', 0) == 'global:a'
+    assert compl.complete('a', 1) is None
+
+
+def test_overridden_colors_are_used():
+    class C(object):
+        foo_a = 1
+        foo_b = 2
+
+    class ObjCompleter(Completer):
+        def color_for_obj(self, i, name, value):
+            return 'CUSTOM:' + name
+
+    compl = ObjCompleter({'c': C(), 'foo_x': 1, 'foo_y': 'x'}, ColorConfig)
+    assert compl.attr_matches('c.foo_') == ['CUSTOM:foo_a', 'CUSTOM:foo_b',
+                                            ' ']
+    assert compl.global_matches('foo_') == ['CUSTOM:foo_x', 'CUSTOM:foo_y',
+                                            ' ']
+
+    class MatchesCompleter(Completer):
+        def color_matches(self, names, values):
+            return ['%s=%r' % item for item in zip(names, values)]
+
+    compl = MatchesCompleter({'c': C()}, ColorConfig)
+    assert compl.attr_matches('c.foo_') == ['foo_a=1', 'foo_b=2']
+    assert compl.complete('c.foo_', 0) == 'foo_a=1'
+
+
+def test_layout_matches():
+    from fancycompleter import _Match, display_width, layout_matches
+    matches = [_Match('aa', '33;01', 0), _Match('bbb', '33;01', 1),
+               _Match('c', None, 2), _Match('dd', '32', 3), ' ']
+    compl = Completer({}, ColorConfig)
+    compl._add_more(matches, ['... 2 more'])
+    # 5 names of at most 10 columns: 2 columns of 12 in 30, down the columns
+    assert layout_matches(matches, 30) == (
+        '\x1b[33;01maa          \x1b[32mdd\n'
+        '\x1b[33;01mbbb         \x1b[00m... 2 more\n'
+        'c\n')
+    assert layout_matches(['foo', 'bar', ' '], 80) == 'foo  bar\n'
+
+    class Config(ColorConfig):
+        max_matches = 2
+
+    compl = Completer({'foo_a': 1, 'foo_b': 2, 'foo_c': 3}, Config)
+    assert layout_matches(compl._global_matches('foo_'), 80) == (
+        '\x1b[33;01mfoo_a       foo_b       \x1b[00m... 1 more\n')
+    assert layout_matches([_Match('x', '31', 0)], 80) == (
+        '\x1b[31mx\x1b[00m\n')
+    assert layout_matches([' '], 80) == ''
+    assert display_width(u'\u4e2d\u6587') == 4
+    assert display_width(u'e\u0301') == 1
+
+
+def test_display_matches(monkeypatch, capsys):
+    class Readline(FakeReadline):
+        redisplayed = False
+
+        def get_line_buffer(self):
+            return 'x = a'
+
+        def redisplay(self):
+            self.redisplayed = True
+
+    compl = Completer({'a': 1, 'ab': 2}, ConfigForTest)
+    compl.config.readline = readline = Readline()
+    monkeypatch.setattr(sys, 'ps1', '>>> ', raising=False)
+    compl.matches = compl._compute_matches('a')
+    compl.display_matches('a', compl.matches, 2)
+    out = capsys.readouterr().out
+    assert out.startswith('\na ')
+    assert out.endswith('\n>>> x = a')
+    assert readline.redisplayed
+
+
 class MyInstaller(Installer):
     env_var = 0
 
@@ -255,3 +1599,7 @@ class TestLazyVersion(object):
         assert str(ver) == '0.1'
         assert ver == '0.1'
         assert not ver != '0.1'
+
+    def test_load_version(self):
+        assert LazyVersion('pytest') == pytest.__version__
+        assert LazyVersion('surely-not-installed-package') == 'N/A'